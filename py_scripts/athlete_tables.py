@@ -0,0 +1,236 @@
+import os
+import numpy as np
+
+from forecast_config import HORIZONS, PERIOD_SECONDS
+from results_store import DEFAULT_ATHLETE
+from run_archive import RunArchive
+
+'''
+Per-athlete lookup tables built from the athlete's archived runs (process_strava_data outputs).
+
+For each target (pace, cadence and speed) the tables hold the sum, sum of squares and count of the
+target in bins of grade, heartrate and elapsed distance. Bin edges are fixed, so a lookup is an
+index computation plus an array read, and adding a run only adds to the sums (rebuilds are
+incremental). Tables are stored as one npz per athlete.
+
+pace is average speed since the start of the run (see process_strava_data); speed is the
+instantaneous speed over each 5s interval, which is what grade changes first.
+
+e.g.:
+    tables = AthleteTables()
+    tables.update(RunArchive())
+    expected_pace = tables.prior('pace', run_frame)
+'''
+
+TARGETS = ('pace', 'cadence', 'speed')
+# dimension -> (first edge, last edge, bin width); values outside the edges go to the end bins
+BINS = {
+    'grade': (-.2, .2, .01),
+    'heartrate': (80., 200., 5.),
+    'distance': (0., 42000., 1000.),
+}
+# bins with fewer samples fall back to the athlete's overall mean
+MIN_COUNT = 30
+# grade is measured over the same look-ahead window as alt_forecast
+GRADE_PERIODS = HORIZONS['song']
+
+
+def n_bins(dim):
+    first, last, width = BINS[dim]
+    return int(round((last - first) / width))
+
+
+def bin_index(dim, values):
+    '''
+    :return:
+        (array): bin of each value; -1 where the value is NaN
+    '''
+    first, last, width = BINS[dim]
+    values = np.asarray(values, dtype=np.float64)
+    idx = np.clip(np.floor((values - first) / width), 0, n_bins(dim) - 1)
+    return np.where(np.isnan(values), -1, idx).astype(np.int64)
+
+
+def grade(run_frame):
+    '''
+    Altitude change over distance covered in the next GRADE_PERIODS intervals (alt_forecast window)
+    '''
+    distance = run_frame.distance.astype(np.float64)
+    ahead = np.empty_like(distance)
+    ahead[:-GRADE_PERIODS] = distance[GRADE_PERIODS:] - distance[:-GRADE_PERIODS]
+    ahead[-GRADE_PERIODS:] = distance[-1] - distance[-GRADE_PERIODS:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        output = run_frame.alt_forecast / ahead
+    # standing still has no grade
+    return np.where(ahead > 1., output, np.nan)
+
+
+def dimension_values(run_frame):
+    return {
+        'grade': grade(run_frame),
+        'heartrate': run_frame.heartrate,
+        'distance': run_frame.distance,
+    }
+
+
+def target_values(run_frame, target):
+    if target == 'speed':
+        return run_frame.dist_delta / PERIOD_SECONDS
+    return run_frame.column(target)
+
+
+class AthleteTables(object):
+    '''
+    Functions include:
+        * update(archive): add every archived run not in the tables yet
+        * lookup(target, dim, values): binned mean of target for each value (O(1) per value)
+        * prior(target, run_frame): expected target per row combining every dimension
+        * has_prior(target): True if the tables hold enough samples of target for a prior
+        * leave_out(run_frame): tables without one run (for backtests)
+    '''
+    def __init__(self, path='../athlete_tables', athlete=DEFAULT_ATHLETE):
+        self.path = path
+        self.athlete = athlete
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    @property
+    def table_path(self):
+        return os.path.join(self.path, f'{self.athlete}.npz')
+
+    def load(self):
+        if os.path.exists(self.table_path):
+            with np.load(self.table_path) as data:
+                self.tables = {k: data[k] for k in data.files if k != 'run_ids'}
+                self.run_ids = set(data['run_ids'].tolist())
+        else:
+            # [target, bin, (sum, sum of squares, count)]; the overall table has a single bin
+            self.tables = {dim: np.zeros((len(TARGETS), n_bins(dim), 3)) for dim in BINS}
+            self.tables['overall'] = np.zeros((len(TARGETS), 1, 3))
+            self.run_ids = set()
+        self.compute_means()
+
+    def save(self):
+        tmp_path = f'{self.table_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, run_ids=np.array(sorted(self.run_ids), dtype=np.int64), **self.tables)
+        os.replace(tmp_path, self.table_path)
+
+    def compute_means(self):
+        '''
+        Mean per bin; bins under MIN_COUNT get the overall mean
+        '''
+        overall = self.tables['overall']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            overall_mean = overall[:, 0, 0] / overall[:, 0, 2]
+            self.means = {'overall': overall_mean}
+            for dim in BINS:
+                sums, counts = self.tables[dim][:, :, 0], self.tables[dim][:, :, 2]
+                self.means[dim] = np.where(counts >= MIN_COUNT, sums / counts, overall_mean[:, None])
+
+    def add_run(self, run_frame, sign=1):
+        '''
+        Adds a run's samples to the sums (sign=-1 removes them)
+        '''
+        dims = {dim: bin_index(dim, values) for dim, values in dimension_values(run_frame).items()}
+        for t, target in enumerate(TARGETS):
+            y = np.asarray(target_values(run_frame, target), dtype=np.float64)
+            valid = ~np.isnan(y)
+            self.tables['overall'][t, 0] += sign * np.array([y[valid].sum(), (y[valid] ** 2).sum(), valid.sum()])
+            for dim, idx in dims.items():
+                keep = valid & (idx >= 0)
+                for col, weights in enumerate((y[keep], y[keep] ** 2, np.ones(keep.sum()))):
+                    self.tables[dim][t, :, col] += sign * np.bincount(idx[keep], weights, minlength=n_bins(dim))
+
+    def update(self, archive=None, run_ids=None):
+        '''
+        :param archive:
+            (RunArchive): defaults to RunArchive() at ../run_archive
+        :param run_ids:
+            (list): runs belonging to this athlete; if none provided, every archived run
+        :return:
+            (list): run ids added
+        '''
+        if archive is None:
+            archive = RunArchive()
+        run_ids = archive.run_ids if run_ids is None else run_ids
+        added = [run_id for run_id in run_ids if run_id not in self.run_ids and run_id in archive]
+        for run_id in added:
+            self.add_run(archive.get_run(run_id))
+            self.run_ids.add(run_id)
+        if added:
+            self.compute_means()
+            self.save()
+        return added
+
+    def remove(self, run_frame):
+        '''
+        Removes an included run (e.g., before re-adding an activity that was updated on Strava)
+        '''
+        if run_frame.run_id in self.run_ids:
+            self.add_run(run_frame, sign=-1)
+            self.run_ids.discard(run_frame.run_id)
+            self.compute_means()
+            self.save()
+
+    def leave_out(self, run_frame):
+        '''
+        In-memory copy without the run's samples, so backtesting an archived run does not use its
+        own data in the prior
+        '''
+        if run_frame.run_id not in self.run_ids:
+            return self
+        output = object.__new__(AthleteTables)
+        output.path, output.athlete = self.path, self.athlete
+        output.tables = {k: v.copy() for k, v in self.tables.items()}
+        output.run_ids = self.run_ids - {run_frame.run_id}
+        output.add_run(run_frame, sign=-1)
+        output.compute_means()
+        return output
+
+    def lookup(self, target, dim, values):
+        '''
+        :return:
+            (array): binned mean of target for each value; overall mean where the value is NaN
+        '''
+        t = TARGETS.index(target)
+        idx = bin_index(dim, values)
+        return np.where(idx >= 0, self.means[dim][t, np.maximum(idx, 0)], self.means['overall'][t])
+
+    def std(self, target, dim, values):
+        t = TARGETS.index(target)
+        sums, sumsq, counts = np.moveaxis(self.tables[dim][t], -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = sumsq / counts - (sums / counts) ** 2
+        idx = bin_index(dim, values)
+        return np.where(idx >= 0, np.sqrt(np.maximum(var, 0))[np.maximum(idx, 0)], np.nan)
+
+    def has_prior(self, target):
+        # with fewer samples the overall mean is unreliable, and with none the prior is NaN
+        return self.tables['overall'][TARGETS.index(target), 0, 2] >= MIN_COUNT
+
+    def prior(self, target, run_frame, start=0, stop=None, dims=tuple(BINS), held=None):
+        '''
+        Expected target per row: overall mean plus each dimension's deviation from it
+        (e.g., an extra regressor or a prior for the forecast)
+        :param held:
+            (dict): dimension -> value used for every row instead of the frame's values (e.g., the
+            last observed heartrate for rows that have not been run yet)
+        :return:
+            (array): float32, one value per row in [start, stop)
+        '''
+        t = TARGETS.index(target)
+        stop = len(run_frame) if stop is None else stop
+        # grade looks ahead, so it is computed on the whole frame before slicing
+        values = dimension_values(run_frame)
+        for dim, value in (held or {}).items():
+            values[dim] = np.full(len(run_frame), value, dtype=np.float64)
+        output = np.full(stop - start, self.means['overall'][t])
+        for dim in dims:
+            output += self.lookup(target, dim, values[dim][start:stop]) - self.means['overall'][t]
+        return output.astype(np.float32)
+
+
+if __name__ == '__main__':
+    tables = AthleteTables()
+    added = tables.update()
+    print(f'Added {len(added)} runs; {len(tables.run_ids)} runs in {tables.table_path}')
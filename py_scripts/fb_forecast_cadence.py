@@ -1,10 +1,7 @@
-import pandas as pd
-import numpy as np
-from fbprophet import Prophet
-import os
-from tqdm import tqdm
-
-from prep_data_FBP import process_data
+from prep_data_FBP import process_run_frame
+from fbp_model import walk_forward_forecast
+from forecast_config import DEFAULT_CONFIG, X_EXOGENOUS, MODEL_VERSION
+from results_store import ResultsStore, DEFAULT_ATHLETE
 
 ''' Script to run predictions on cadence for a run
 
@@ -13,122 +10,73 @@ TODO:
 2) Create parent class to be shared with pace predictor
 '''
 
-x_exogenous = ['temp', 'distance', 'altitude', 'alt_delta', 'alt_forecast']
-
-class suppress_stdout_stderr(object):
-    '''
-    A context manager for doing a "deep suppression" of stdout and stderr in
-    Python, i.e. will suppress all print, even if the print originates in a
-    compiled C/Fortran sub-function.
-       This will not suppress raised exceptions, since exceptions are printed
-    to stderr just before a script exits, and after the context manager has
-    exited (at least, I think that is why it lets exceptions through).
+x_exogenous = X_EXOGENOUS
 
+def create_run_frame(chosen_run_id):
     '''
-    def __init__(self):
-        # Open a pair of null files
-        self.null_fds = [os.open(os.devnull, os.O_RDWR) for x in range(2)]
-        # Save the actual stdout (1) and stderr (2) file descriptors.
-        self.save_fds = (os.dup(1), os.dup(2))
-
-    def __enter__(self):
-        # Assign the null pointers to stdout and stderr.
-        os.dup2(self.null_fds[0], 1)
-        os.dup2(self.null_fds[1], 2)
-
-    def __exit__(self, *_):
-        # Re-assign the real stdout/stderr back to (1) and (2)
-        os.dup2(self.save_fds[0], 1)
-        os.dup2(self.save_fds[1], 2)
-        # Close the null files
-        os.close(self.null_fds[0])
-        os.close(self.null_fds[1])
-
-def create_fbp_df(chosen_run_id):
-    '''
-    Based on Strava run id, put together a dataframe in the appropriate format to be used in Facebook Prophet
+    Based on Strava run id, load the processed run as a RunFrame. Dataframes for Facebook Prophet
+    are built from views of the frame for each window.
     :param chosen_run_id:
         (int): Strava run id for run to be analyzed
     :return:
-        (dataframe): time, cadence, 'temp', 'distance', 'altitude', 'alt_delta', 'alt_forecast'
-    '''
-    run_id, run_date, proc_data_df = process_data(chosen_run_id)
-    print(f'Predicting pace for run: {run_id}')
-    # Split data into time and exogenous vars
-    x_time = ['5s_intervals', 'cadence']
-    run_time = proc_data_df[x_time]
-    run_time.rename({'5s_intervals': 'ds', 'cadence': 'y'}, axis=1, inplace=True)
-    samp_run_exo = proc_data_df[x_exogenous]
-    # FB Prophet only takes time as datetime64 with no time zone
-    run_time['ds'] = (np.array(run_date) + run_time['ds'].astype('timedelta64[s]')).dt.tz_localize(None)
-    exo_df = pd.DataFrame(samp_run_exo, index=samp_run_exo.index, columns=samp_run_exo.columns)
-    fbp_df = run_time.join(exo_df)
-    return fbp_df
-
-def create_prophet_with_exo(feats):
-    '''
-    Instance facebook prophet model
-    :param feats:
-        (list):
-    :return:
-        Facebook Prophet model
+        (RunFrame): 5s interval data for the run
     '''
-    model = Prophet(interval_width=.95)
-    for feat in feats:
-        model.add_regressor(feat)
-    return model
+    run_frame = process_run_frame(chosen_run_id)
+    print(f'Predicting cadence for run: {run_frame.run_id}')
+    return run_frame
 
-def fit_fbp_model(chosen_run_id, train_period = 36):
-    # If train period is changed, value in process_prophete_output;analyze_music() function needs
-    # to be revised as well. Need to link the values
+def fit_fbp_model(chosen_run_id, config=DEFAULT_CONFIG, uncertainty='off', store=None,
+                  model_version=MODEL_VERSION, athlete=DEFAULT_ATHLETE, tables=None, scheduler=None):
     '''
-    Fits and predicts as run progresses
-    :param train_period:
-        (int): number of initial training periods (each period being 5 seconds)
+    Fits and predicts as run progresses. Each refit forecasts every horizon in config
+    (forecast_config.py holds the training period, refit cadence and horizons)
+    :param config:
+        (ForecastConfig): training/horizon settings
+    :param uncertainty:
+        (str): 'off' (default, fastest), 'analytic', 'reduced' or 'full'. If not 'off', lower/upper
+        columns are included for each horizon
+    :param store:
+        (ResultsStore): if provided, the updates are written to the store as one part per run
+    :param tables:
+        (AthleteTables): if provided, the athlete's expected cadence (without this run) is added as a regressor
+    :param scheduler:
+        (RefitScheduler): if provided, refits only on drift/max staleness instead of every update
     :return:
-        pace_pred_dict(dict): keys are 30 second time intervals and values are avg cadence for the corresponding period
-        fbp_df (dataframe): Entire dataframe with all predictions for each 5s interval
+        horizon_df (dataframe): one row per update (refit column marks refits); ds is the first forecast interval, yhat_<horizon>/y_<horizon>
+            are the avg forecast/actual cadence over each horizon
+        fbp_df (dataframe): Entire dataframe for each 5s interval
     '''
-    pace_pred_dict = {}
-    fbp_df = create_fbp_df(chosen_run_id)
-    # 5s per period (36 * 5 = 180 or 3 min of training)
-    forecast_period = 6
-    iters = (fbp_df.shape[0] - train_period) // forecast_period
-    for periods in tqdm(range(iters)):
-        m = create_prophet_with_exo(x_exogenous)
-        running_fc = train_period + periods * forecast_period
-        with suppress_stdout_stderr():
-            m.fit(fbp_df.iloc[:running_fc])
-        pred_frame = m.make_future_dataframe(periods=forecast_period, freq='5s')
-        future_exog = fbp_df.loc[:, x_exogenous].reset_index()
-        future_exog.drop('index', axis=1, inplace=True)
-        pred_frame = pred_frame.join(future_exog)
-        pred_pace = m.predict(pred_frame)
-        # Record prediction at forecast points
-        pred_time = pred_pace.iloc[-forecast_period,0]
-        pace_pred_dict[pred_time] = pred_pace['yhat'][-forecast_period:].mean()
-    return pace_pred_dict, fbp_df
+    run_frame = create_run_frame(chosen_run_id)
+    if tables is not None:
+        tables = tables.leave_out(run_frame)
+    horizon_df = walk_forward_forecast(run_frame, 'cadence', config, uncertainty, tables=tables,
+                                       scheduler=scheduler)
+    if store is not None:
+        # one part per run, replaced when the run is backtested again
+        store.write(horizon_df, model_version, 'cadence', athlete, run_frame.run_id, part_id=run_frame.run_id)
+    fbp_df = run_frame.to_fbp_df('cadence', config.x_exogenous)
+    return horizon_df, fbp_df
 
-def actual_vs_predict(chosen_run_id=None):
+def actual_vs_predict(chosen_run_id=None, uncertainty='off', store=None):
     '''
-    (temp) Creates pickle files of prediction results. This can be deprecated once analysis is complete.
+    Runs the walk-forward forecast for a run and records the results in the results store
     :param chosen_run_id:
         (int): Selected Strava run id. If none provided, the default is selected
+    :param uncertainty:
+        (str): passed to fit_fbp_model; adds lower/upper columns per horizon if not 'off'
+    :param store:
+        (ResultsStore): defaults to ResultsStore() at ../results_store
     :return:
-        None: only pickle files saved
+        (dataframe): forecasts merged with the actual 5s interval data
     '''
-    temp_dict, fbp_df = fit_fbp_model(chosen_run_id)
-    result_df = pd.DataFrame.from_dict(temp_dict, orient='index').reset_index()
-    fbp_df.to_pickle('../pkls/result_fbp.pkl')
-    result_df.rename({'index':'ds', 0:'yhat'}, axis=1, inplace=True)
-    result_df = result_df.merge(fbp_df, on='ds')
-    if chosen_run_id:
-        result_df.to_pickle(f'../pkls/cadence_df_{chosen_run_id}.pkl')
-    else:
-        result_df.to_pickle('../pkls/cadence_df(train0).pkl')
+    if store is None:
+        store = ResultsStore()
+    result_df, fbp_df = fit_fbp_model(chosen_run_id, uncertainty=uncertainty, store=store)
+    # yhat stays the 30s song switching forecast
+    result_df['yhat'] = result_df[f'yhat_{DEFAULT_CONFIG.primary_horizon}']
+    return result_df.merge(fbp_df, on='ds')
 
 if __name__ == "__main__":
     run_id = int(input('Enter run id:'))
     actual_vs_predict(run_id)
     # fit_fbp_model()
-    # print(create_fbp_df().head(20))
\ No newline at end of file
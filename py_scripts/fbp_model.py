@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+import os
+from scipy import stats
+from fbprophet import Prophet
+from tqdm import tqdm
+
+from forecast_config import DEFAULT_CONFIG, PERIOD_SECONDS
+
+''' Facebook Prophet helpers shared by the pace and cadence forecasters
+
+Uncertainty modes for create_prophet_with_exo/predict_future:
+    * 'full': Prophet default Monte Carlo simulation (1000 draws)
+    * 'reduced': Monte Carlo simulation with 100 draws
+    * 'analytic': no simulation; interval from fitted observation noise (ignores trend uncertainty)
+    * 'off': no simulation and no interval columns
+'''
+
+UNCERTAINTY_SAMPLES = {'full': 1000, 'reduced': 100, 'analytic': 0, 'off': 0}
+
+
+class suppress_stdout_stderr(object):
+    '''
+    A context manager for doing a "deep suppression" of stdout and stderr in
+    Python, i.e. will suppress all print, even if the print originates in a
+    compiled C/Fortran sub-function.
+       This will not suppress raised exceptions, since exceptions are printed
+    to stderr just before a script exits, and after the context manager has
+    exited (at least, I think that is why it lets exceptions through).
+
+    '''
+    def __init__(self):
+        # Open a pair of null files
+        self.null_fds = [os.open(os.devnull, os.O_RDWR) for x in range(2)]
+        # Save the actual stdout (1) and stderr (2) file descriptors.
+        self.save_fds = (os.dup(1), os.dup(2))
+
+    def __enter__(self):
+        # Assign the null pointers to stdout and stderr.
+        os.dup2(self.null_fds[0], 1)
+        os.dup2(self.null_fds[1], 2)
+
+    def __exit__(self, *_):
+        # Re-assign the real stdout/stderr back to (1) and (2)
+        os.dup2(self.save_fds[0], 1)
+        os.dup2(self.save_fds[1], 2)
+        # Close the null files
+        os.close(self.null_fds[0])
+        os.close(self.null_fds[1])
+
+
+def create_prophet_with_exo(feats, interval_width=.95, uncertainty='full', regressor_prior_scale=None,
+                            **prophet_kwargs):
+    '''
+    Instance facebook prophet model
+    :param feats:
+        (list): exogenous regressors to add to the model
+    :param uncertainty:
+        (str): 'full', 'reduced', 'analytic' or 'off'; anything but 'full'/'reduced' disables
+        Monte Carlo sampling in predict
+    :param regressor_prior_scale:
+        (float): prior scale for every regressor; None uses Prophet's default
+    :param prophet_kwargs:
+        passed to Prophet (e.g., changepoint_prior_scale)
+    :return:
+        Facebook Prophet model
+    '''
+    if uncertainty not in UNCERTAINTY_SAMPLES:
+        raise Exception(f'uncertainty must be one of {list(UNCERTAINTY_SAMPLES)}')
+    model = Prophet(interval_width=interval_width,
+                    uncertainty_samples=UNCERTAINTY_SAMPLES[uncertainty], **prophet_kwargs)
+    for feat in feats:
+        model.add_regressor(feat, prior_scale=regressor_prior_scale)
+    return model
+
+
+def observation_sigma(model):
+    '''
+    Fitted observation noise in target units (sigma_obs is fit on the scaled target)
+    '''
+    return float(np.mean(model.params['sigma_obs'])) * model.y_scale
+
+
+def predict_future(model, future_df, uncertainty='off'):
+    '''
+    Predicts only the rows passed in (e.g., the forecast period) rather than history + forecast
+    :param future_df:
+        (dataframe): ds plus regressor columns for the periods to forecast
+    :param uncertainty:
+        (str): same mode the model was created with
+    :return:
+        (dataframe): Prophet forecast; yhat_lower/yhat_upper only included if uncertainty != 'off'
+    '''
+    forecast = model.predict(future_df)
+    if uncertainty == 'analytic':
+        sigma = observation_sigma(model)
+        z = stats.norm.ppf(0.5 + model.interval_width / 2)
+        forecast['yhat_lower'] = forecast['yhat'] - z * sigma
+        forecast['yhat_upper'] = forecast['yhat'] + z * sigma
+    elif uncertainty == 'off':
+        forecast = forecast.drop(['yhat_lower', 'yhat_upper'], axis=1, errors='ignore')
+    return forecast
+
+
+def summarize_horizons(forecast, horizons, uncertainty='off', actual=None):
+    '''
+    Averages a forecast over each horizon (all horizons start at the first forecast row)
+    :param forecast:
+        (dataframe): output of predict_future
+    :param horizons:
+        (dict): horizon name to number of 5s periods
+    :param actual:
+        (array): observed target from the first forecast row on; adds y_<horizon> averages
+    :return:
+        (dict): ds plus yhat_<horizon> (and _lower/_upper if uncertainty != 'off'); horizons that
+        run past the end of the forecast are NaN
+    '''
+    cols = ['yhat'] if uncertainty == 'off' else ['yhat', 'yhat_lower', 'yhat_upper']
+    summary = {'ds': forecast.loc[0, 'ds']}
+    for name, periods in horizons.items():
+        full_horizon = forecast.shape[0] >= periods
+        for col in cols:
+            key = col.replace('yhat', f'yhat_{name}', 1)
+            summary[key] = forecast[col].iloc[:periods].mean() if full_horizon else np.nan
+        if actual is not None:
+            summary[f'y_{name}'] = float(np.mean(actual[:periods])) if full_horizon else np.nan
+    return summary
+
+
+def fit_model(run_frame, target, stop, config=DEFAULT_CONFIG, uncertainty='off', tables=None):
+    '''
+    Fits on the first stop rows of the run
+    :param tables:
+        (AthleteTables): optional; adds the athlete's expected target for each row (<target>_prior)
+        as an extra regressor so the model does not learn grade/heartrate effects from scratch.
+        Skipped while the tables have too few samples (see AthleteTables.has_prior)
+    :return:
+        fitted Facebook Prophet model
+    '''
+    feats = list(config.x_exogenous)
+    train_df = run_frame.to_fbp_df(target, config.x_exogenous, stop=stop)
+    if tables is not None and tables.has_prior(target):
+        feats.append(f'{target}_prior')
+        train_df[feats[-1]] = tables.prior(target, run_frame, stop=stop)
+    m = create_prophet_with_exo(feats, config.interval_width, uncertainty, **config.prophet_kwargs)
+    with suppress_stdout_stderr():
+        m.fit(train_df)
+    return m
+
+
+def forecast_model(model, run_frame, target, stop, future_frame, config=DEFAULT_CONFIG, uncertainty='off',
+                   tables=None):
+    '''
+    Forecasts one row per future_frame row with an already fitted model (which may have been fit
+    on fewer than stop rows)
+    :param future_frame:
+        (RunFrame): regressors for the forecast periods; row 0 is the first period after stop
+    :return:
+        (dataframe): output of predict_future
+    '''
+    pred_frame = future_frame.to_fbp_df(None, config.x_exogenous)
+    # only if the model was fit with the prior (see fit_model)
+    if tables is not None and f'{target}_prior' in model.extra_regressors:
+        # heartrate after stop is not known at forecast time; hold the last observed value
+        heartrate = run_frame.column('heartrate', stop=stop)
+        heartrate = heartrate[~np.isnan(heartrate)]
+        held = {'heartrate': heartrate[-1] if heartrate.size else np.nan}
+        pred_frame[f'{target}_prior'] = tables.prior(target, future_frame, held=held)
+    # forecast periods continue the run's 5s timeline
+    steps = np.arange(1, len(future_frame) + 1) * np.timedelta64(PERIOD_SECONDS, 's')
+    pred_frame['ds'] = run_frame.ds(stop - 1, stop)[0] + steps
+    return predict_future(model, pred_frame, uncertainty=uncertainty)
+
+
+def fit_and_forecast(run_frame, target, stop, future_frame, config=DEFAULT_CONFIG, uncertainty='off',
+                     tables=None):
+    '''
+    Fits on the first stop rows of the run and forecasts one row per future_frame row
+    (see fit_model/forecast_model)
+    :return:
+        model: fitted Facebook Prophet model
+        forecast (dataframe): output of predict_future
+    '''
+    m = fit_model(run_frame, target, stop, config, uncertainty, tables)
+    return m, forecast_model(m, run_frame, target, stop, future_frame, config, uncertainty, tables)
+
+
+def walk_forward_forecast(run_frame, target, config=DEFAULT_CONFIG, uncertainty='off', on_update=None,
+                          progress=True, tables=None, scheduler=None):
+    '''
+    Forecasts every configured horizon as the run progresses (every config.update_period). Refits
+    at every update unless a scheduler is given
+    :param run_frame:
+        (RunFrame): processed run
+    :param target:
+        (str): 'pace' or 'cadence'
+    :param on_update:
+        (callable): called with each update's summary dict as soon as it is forecast
+        (e.g., ResultsWriter.add)
+    :param progress:
+        (bool): show a tqdm progress bar
+    :param tables:
+        (AthleteTables): optional prior regressor; see fit_model
+    :param scheduler:
+        (RefitScheduler): refit only when it detects drift or the model is too old; other updates
+        forecast with the current model
+    :return:
+        (dataframe): one row per update; see summarize_horizons (with actuals) plus refit (bool).
+        For pace with config.eta, yhat_eta/y_eta are the predicted/actual elapsed seconds at the end
+        of the run
+    '''
+    records = []
+    n_rows = len(run_frame)
+    with_eta = config.eta and target == 'pace'
+    total_distance = float(run_frame.distance[-1]) if n_rows else np.nan
+    iters = (n_rows - config.train_period) // config.update_period
+    model, prev_fc, prev_yhat = None, None, None
+    if scheduler is not None:
+        scheduler.start(run_frame, config)
+    for update in tqdm(range(iters), disable=not progress):
+        running_fc = config.train_period + update * config.update_period
+        # One predict covers every horizon (or the rest of the run for the ETA)
+        stop = n_rows if with_eta else min(n_rows, running_fc + config.max_horizon)
+        refit = model is None or scheduler is None
+        if not refit:
+            # errors of the current model on the rows observed since the previous update
+            observed = run_frame.column(target, start=prev_fc, stop=running_fc)
+            residuals = observed - prev_yhat[:len(observed)]
+            refit = scheduler.should_refit(running_fc, residuals)
+        if refit:
+            model = fit_model(run_frame, target, running_fc, config, uncertainty, tables)
+            if scheduler is not None:
+                scheduler.fitted(running_fc, observation_sigma(model))
+        forecast = forecast_model(model, run_frame, target, running_fc, run_frame.window(running_fc, stop),
+                                  config, uncertainty, tables)
+        prev_fc, prev_yhat = running_fc, forecast['yhat'].to_numpy()
+        actual = run_frame.column(target, start=running_fc, stop=stop)
+        summary = summarize_horizons(forecast, config.horizons, uncertainty, actual=actual)
+        summary['refit'] = refit
+        if with_eta:
+            # pace is average speed since the start, so finish time = distance / final pace
+            summary['yhat_eta'] = total_distance / forecast['yhat'].iloc[-1]
+            summary['y_eta'] = float(run_frame.time[-1])
+        if on_update is not None:
+            on_update(summary)
+        records.append(summary)
+    return pd.DataFrame(records)
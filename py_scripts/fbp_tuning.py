@@ -0,0 +1,242 @@
+import itertools
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from fbp_model import walk_forward_forecast
+from forecast_config import DEFAULT_CONFIG, ForecastConfig, X_EXOGENOUS
+from run_archive import RunArchive
+
+''' Hyperparameter search for the walk-forward forecaster
+
+Trials are (config, run) pairs evaluated in parallel worker processes. Runs are read from the
+RunArchive, which each worker opens once and memory-maps, so prepared frames are shared across
+trials and processes. Successive halving evaluates every config on a few runs, keeps the best
+1/eta and repeats on more runs, so clearly losing configs are dropped early.
+
+Every trial is scored on the same forecast origins (rows from the largest train_period on, on a
+grid every trial's update_period reaches), so configs that skip the early, hardest windows are not
+favored. Models are fit on every row before the origin, so train_period/update_period only change
+the compute cost and are not in SEARCH_SPACE; nor is interval_width, which does not change the mae
+(coverage is still reported).
+
+e.g.:
+    ranked_df = search(SEARCH_SPACE, RunArchive(), target='pace', method='halving')
+'''
+
+# ForecastConfig arguments; every other search parameter is passed to Prophet
+CONFIG_PARAMS = ('train_period', 'update_period', 'interval_width', 'x_exogenous')
+
+SEARCH_SPACE = {
+    'x_exogenous': [tuple(X_EXOGENOUS), ('distance', 'alt_delta', 'alt_forecast'), ('alt_delta', 'alt_forecast')],
+    'changepoint_prior_scale': [.01, .05, .5],
+    'regressor_prior_scale': [1., 10.],
+}
+
+_worker_archive = None
+
+
+def grid_configs(space):
+    '''
+    :return:
+        (list): every combination of the search space as a dict of params
+    '''
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[k] for k in names])]
+
+
+def random_configs(space, n_trials, random_state=444):
+    '''
+    :return:
+        (list): n_trials distinct random combinations (fewer if the grid is smaller)
+    '''
+    configs = grid_configs(space)
+    random.seed(random_state)
+    return random.sample(configs, k=min(n_trials, len(configs)))
+
+
+def build_config(params, base=DEFAULT_CONFIG):
+    '''
+    ForecastConfig for a trial. Only the primary horizon is forecast and the ETA is skipped since
+    trials are scored on the primary horizon
+    '''
+    config_kwargs = {k: v for k, v in params.items() if k in CONFIG_PARAMS}
+    prophet_kwargs = dict(base.prophet_kwargs)
+    prophet_kwargs.update({k: v for k, v in params.items() if k not in CONFIG_PARAMS})
+    return ForecastConfig(
+        train_period=config_kwargs.get('train_period', base.train_period),
+        update_period=config_kwargs.get('update_period', base.update_period),
+        horizons={base.primary_horizon: base.horizons[base.primary_horizon]},
+        primary_horizon=base.primary_horizon,
+        eta=False,
+        x_exogenous=config_kwargs.get('x_exogenous', base.x_exogenous),
+        interval_width=config_kwargs.get('interval_width', base.interval_width),
+        prophet_kwargs=prophet_kwargs,
+    )
+
+
+def shared_origins(configs, base=DEFAULT_CONFIG, max_search=10000):
+    '''
+    First forecast origin (row) reached by every config at or after the largest train_period, and the
+    step between shared origins (least common multiple of the update periods)
+    :return:
+        eval_start, eval_step (ints)
+    '''
+    periods = {(params.get('train_period', base.train_period), params.get('update_period', base.update_period))
+               for params in configs}
+    eval_step = int(np.lcm.reduce([update for _, update in periods]))
+    first = max(train for train, _ in periods)
+    for eval_start in range(first, first + max_search):
+        if all((eval_start - train) % update == 0 for train, update in periods):
+            return eval_start, eval_step
+    raise Exception('train_period/update_period values share no forecast origin; use fewer combinations')
+
+
+def init_worker(archive_path):
+    global _worker_archive
+    _worker_archive = RunArchive(archive_path)
+
+
+def evaluate_trial(task):
+    '''
+    Runs the walk-forward forecast for one (config, run) pair in a worker process
+    :param task:
+        (tuple): trial_id, params, run_id, target, eval_start, eval_step (see shared_origins)
+    :return:
+        (dict): error sums, interval coverage count and fit/predict seconds for the run, over the
+        shared forecast origins
+    '''
+    trial_id, params, run_id, target, eval_start, eval_step = task
+    config = build_config(params)
+    run_frame = _worker_archive.get_run(run_id)
+    start = time.perf_counter()
+    # analytic intervals cost nothing extra and give the coverage
+    result_df = walk_forward_forecast(run_frame, target, config, uncertainty='analytic', progress=False)
+    seconds = time.perf_counter() - start
+    record = {'trial_id': trial_id, 'run_id': run_id, 'n_windows': 0, 'abs_err': 0., 'sq_err': 0.,
+              'covered': 0, 'seconds': seconds}
+    if result_df.empty:
+        return record
+    h = config.primary_horizon
+    # one row per update, forecast from row train_period + update * update_period
+    origins = config.train_period + np.arange(result_df.shape[0]) * config.update_period
+    shared = (origins >= eval_start) & ((origins - eval_start) % eval_step == 0)
+    scored = result_df[shared].dropna(subset=[f'yhat_{h}', f'y_{h}'])
+    err = scored[f'yhat_{h}'] - scored[f'y_{h}']
+    record.update({
+        'n_windows': scored.shape[0],
+        'abs_err': err.abs().sum(),
+        'sq_err': (err ** 2).sum(),
+        'covered': scored[f'y_{h}'].between(scored[f'yhat_{h}_lower'], scored[f'yhat_{h}_upper']).sum(),
+    })
+    return record
+
+
+def rank_trials(records, configs):
+    '''
+    :param records:
+        (list): evaluate_trial outputs
+    :param configs:
+        (list): params for each trial id
+    :return:
+        (dataframe): one row per trial; runs, n_windows, mae, rmse, coverage, sec_per_window and the
+        trial params. Trials evaluated on more runs (survivors) first, then by mae
+    '''
+    records_df = pd.DataFrame(records)
+    trials_df = records_df.groupby('trial_id').agg(
+        runs=('run_id', 'nunique'), n_windows=('n_windows', 'sum'), abs_err=('abs_err', 'sum'),
+        sq_err=('sq_err', 'sum'), covered=('covered', 'sum'), seconds=('seconds', 'sum'))
+    n_windows = trials_df['n_windows'].replace(0, np.nan)
+    trials_df['mae'] = trials_df['abs_err'] / n_windows
+    trials_df['rmse'] = np.sqrt(trials_df['sq_err'] / n_windows)
+    trials_df['coverage'] = trials_df['covered'] / n_windows
+    trials_df['sec_per_window'] = trials_df['seconds'] / n_windows
+    params_df = pd.DataFrame([configs[t] for t in trials_df.index], index=trials_df.index)
+    ranked_df = trials_df[['runs', 'n_windows', 'mae', 'rmse', 'coverage', 'sec_per_window']].join(params_df)
+    ranked_df = ranked_df.sort_values(['runs', 'mae'], ascending=[False, True])
+    return ranked_df.reset_index()
+
+
+def evaluate(configs, run_ids, target, pool, done=None, trial_ids=None):
+    '''
+    Evaluates trials on every run they have not been evaluated on yet, all on the same forecast
+    origins (see shared_origins)
+    :param done:
+        (dict): trial id -> set of run ids already evaluated (updated in place)
+    :return:
+        (list): new evaluate_trial records
+    '''
+    done = {} if done is None else done
+    trial_ids = range(len(configs)) if trial_ids is None else trial_ids
+    eval_start, eval_step = shared_origins(configs)
+    tasks = [(t, configs[t], run_id, target, eval_start, eval_step) for t in trial_ids for run_id in run_ids
+             if run_id not in done.setdefault(t, set())]
+    records = list(pool.map(evaluate_trial, tasks))
+    for record in records:
+        done[record['trial_id']].add(record['run_id'])
+    return records
+
+
+def successive_halving(configs, run_ids, target, pool, min_runs=2, eta=3):
+    '''
+    :param min_runs:
+        (int): runs every config is evaluated on in the first rung
+    :param eta:
+        (int): keep the best 1/eta configs and multiply runs by eta each rung
+    :return:
+        (list): evaluate_trial records for every trial and rung
+    '''
+    records = []
+    done = {}
+    alive = list(range(len(configs)))
+    n_runs = min(min_runs, len(run_ids))
+    while True:
+        records += evaluate(configs, run_ids[:n_runs], target, pool, done, alive)
+        if len(alive) <= 1 or n_runs >= len(run_ids):
+            return records
+        ranked_df = rank_trials([r for r in records if r['trial_id'] in alive], configs)
+        alive = list(ranked_df['trial_id'][:math.ceil(len(alive) / eta)])
+        n_runs = min(len(run_ids), n_runs * eta)
+
+
+def search(space, archive, target='pace', method='halving', n_trials=20, run_ids=None, min_runs=2,
+           eta=3, max_workers=None, random_state=444):
+    '''
+    Hyperparameter search over cached runs
+    :param space:
+        (dict): param name -> list of values (see SEARCH_SPACE)
+    :param archive:
+        (RunArchive): preprocessed runs to evaluate on
+    :param method:
+        (str): 'grid' (every combination on every run), 'random' (n_trials combinations on every run)
+        or 'halving' (n_trials random combinations with successive halving)
+    :param run_ids:
+        (list): runs to use; if none provided, every archived run in random order
+    :return:
+        (dataframe): ranked accuracy vs. compute cost per window (see rank_trials)
+    '''
+    if method == 'grid':
+        configs = grid_configs(space)
+    elif method in ('random', 'halving'):
+        configs = random_configs(space, n_trials, random_state)
+    else:
+        raise Exception("method must be 'grid', 'random' or 'halving'")
+    if run_ids is None:
+        run_ids = archive.run_ids
+        random.seed(random_state)
+        random.shuffle(run_ids)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                             initargs=(archive.path,)) as pool:
+        if method == 'halving':
+            records = successive_halving(configs, run_ids, target, pool, min_runs, eta)
+        else:
+            records = evaluate(configs, run_ids, target, pool)
+    return rank_trials(records, configs)
+
+
+if __name__ == '__main__':
+    ranked_df = search(SEARCH_SPACE, RunArchive(), target=input('Enter target (pace/cadence):'))
+    print(ranked_df.head(20).to_string())
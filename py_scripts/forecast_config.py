@@ -0,0 +1,73 @@
+''' Training and forecast horizon settings shared by the forecasters and music selection
+
+All periods are counted in 5 second intervals (see process_strava_data.extract_5s_increments).
+'''
+
+PERIOD_SECONDS = 5
+
+# partition key in the results store; bump when the model or its features change
+MODEL_VERSION = 'prophet_exo_v1'
+
+X_EXOGENOUS = ['temp', 'distance', 'altitude', 'alt_delta', 'alt_forecast']
+
+# name: number of 5s periods forecast from each fit
+HORIZONS = {
+    'song': 6,          # 30s; song switching
+    'queue_2min': 24,   # queue planning
+    'queue_5min': 60,
+}
+
+
+class ForecastConfig(object):
+    '''
+    Settings for a walk-forward forecast:
+        * train_period: initial training periods before the first forecast (36 = 3 min)
+        * update_period: periods between refits (6 = 30s)
+        * horizons: dict of horizon name to periods forecast from each fit
+        * primary_horizon: horizon reported as 'yhat' (used for song switching)
+        * eta: also forecast the rest of the run each update for a whole-run ETA (pace only). Off by
+          default since every update then predicts the whole remaining run instead of max_horizon rows
+        * prophet_kwargs: extra Prophet settings (e.g., changepoint_prior_scale, regressor_prior_scale)
+    '''
+    def __init__(self, train_period=36, update_period=6, horizons=None, primary_horizon='song',
+                 eta=False, x_exogenous=None, interval_width=.95, prophet_kwargs=None):
+        self.train_period = train_period
+        self.update_period = update_period
+        self.horizons = dict(HORIZONS if horizons is None else horizons)
+        if primary_horizon not in self.horizons:
+            raise Exception(f'primary_horizon must be one of {list(self.horizons)}')
+        self.primary_horizon = primary_horizon
+        self.eta = eta
+        self.x_exogenous = list(X_EXOGENOUS if x_exogenous is None else x_exogenous)
+        self.interval_width = interval_width
+        self.prophet_kwargs = dict(prophet_kwargs or {})
+
+    def to_dict(self):
+        '''
+        Constructor arguments (JSON serializable); ForecastConfig(**config.to_dict()) recreates the config
+        '''
+        return {
+            'train_period': self.train_period,
+            'update_period': self.update_period,
+            'horizons': dict(self.horizons),
+            'primary_horizon': self.primary_horizon,
+            'eta': self.eta,
+            'x_exogenous': list(self.x_exogenous),
+            'interval_width': self.interval_width,
+            'prophet_kwargs': dict(self.prophet_kwargs),
+        }
+
+    @property
+    def max_horizon(self):
+        return max(self.horizons.values())
+
+    @property
+    def train_seconds(self):
+        return self.train_period * PERIOD_SECONDS
+
+    @property
+    def update_seconds(self):
+        return self.update_period * PERIOD_SECONDS
+
+
+DEFAULT_CONFIG = ForecastConfig()
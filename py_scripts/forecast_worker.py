@@ -0,0 +1,404 @@
+import time
+import numpy as np
+from multiprocessing import Process, shared_memory
+
+from fbp_model import fit_model, forecast_model, summarize_horizons
+from forecast_config import DEFAULT_CONFIG, PERIOD_SECONDS
+from run_archive import RunArchive
+from run_frame import RunFrame, COLUMNS, FLOAT_COLUMNS
+from session_checkpoint import SessionCheckpoint
+
+''' Out-of-process forecaster for live playback
+
+The playback loop pushes each 5s sample into a shared-memory ring buffer (SampleRing). A worker
+process reads new samples, refits every config.update_period samples and publishes the latest
+horizon forecasts into a shared-memory slot (ForecastSlot). The slot is guarded by a sequence
+counter, so the playback loop reads the freshest forecast without locks, blocking or pickling.
+
+ForecastWorker runs in the playback process: it owns the shared memory, flags stale forecasts and
+restarts the worker if it dies or stops sending heartbeats.
+
+With a SessionCheckpoint, samples and each fitted model are saved as they arrive; after a crash
+ForecastWorker.resume() reloads them and the worker publishes a forecast from the saved model
+without refitting.
+'''
+
+# a 6 hour run at 5s intervals. The ring and the worker's history keep the newest capacity samples,
+# so longer runs are fit on a rolling window
+DEFAULT_CAPACITY = 4320
+# samples averaged for the speed extrapolated by hold_last_frame (30s)
+RECENT_PERIODS = 6
+
+
+def open_shared_memory(name, size):
+    '''
+    Creates a block if name is None, otherwise attaches to an existing one
+    '''
+    if name is None:
+        return shared_memory.SharedMemory(create=True, size=size)
+    # worker processes share the playback process' resource tracker, which unlinks blocks only if
+    # the playback process exits without calling stop()
+    return shared_memory.SharedMemory(name=name)
+
+
+class SampleRing(object):
+    '''
+    Single-writer ring buffer of processed samples (one row per 5s interval, RunFrame COLUMNS order)
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY, name=None):
+        self.capacity = capacity
+        self.shm = open_shared_memory(name, 8 + capacity * len(COLUMNS) * 8)
+        self.name = self.shm.name
+        # header[0]: number of samples ever pushed
+        self.header = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((capacity, len(COLUMNS)), dtype=np.float64, buffer=self.shm.buf, offset=8)
+        if name is None:
+            self.header[0] = 0
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    def push(self, sample):
+        '''
+        :param sample:
+            (dict): column -> value; missing columns are NaN
+        '''
+        count = self.count
+        self.data[count % self.capacity] = [sample.get(col, np.nan) for col in COLUMNS]
+        # publish the row only after it is written
+        self.header[0] = count + 1
+
+    def read_since(self, seen):
+        '''
+        :param seen:
+            (int): count returned by the previous call (0 on first call)
+        :return:
+            count (int): samples pushed so far
+            rows (array): samples pushed since seen (at most capacity rows)
+        '''
+        count = self.count
+        first = max(seen, count - self.capacity)
+        rows = self.data[np.arange(first, count) % self.capacity].copy()
+        return count, rows
+
+    def close(self, unlink=False):
+        del self.header, self.data
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ForecastSlot(object):
+    '''
+    Latest forecast (one float per field) guarded by a sequence counter: the writer makes it odd
+    while writing, readers retry if it is odd or changed while copying
+    '''
+    def __init__(self, fields, name=None):
+        self.fields = list(fields)
+        self.shm = open_shared_memory(name, 8 * (4 + len(self.fields)))
+        self.name = self.shm.name
+        # seq, published_at, samples_seen, heartbeat_at
+        self.header = np.ndarray((4,), dtype=np.float64, buffer=self.shm.buf)
+        self.values = np.ndarray((len(self.fields),), dtype=np.float64, buffer=self.shm.buf, offset=32)
+        if name is None:
+            self.header[:] = [0, np.nan, 0, np.nan]
+            self.values[:] = np.nan
+
+    def publish(self, values, samples_seen):
+        self.header[0] += 1
+        self.values[:] = [values.get(field, np.nan) for field in self.fields]
+        self.header[1] = time.time()
+        self.header[2] = samples_seen
+        self.header[0] += 1
+
+    def heartbeat(self):
+        self.header[3] = time.time()
+
+    def recover(self):
+        '''
+        Call while no writer is running (e.g., before starting a worker). If a writer was killed
+        mid-publish the sequence is left odd and the values may be half written, so the slot is
+        cleared back to "nothing published"
+        '''
+        if int(self.header[0]) % 2:
+            self.values[:] = np.nan
+            self.header[:3] = [0, np.nan, 0]
+
+    @property
+    def heartbeat_at(self):
+        return float(self.header[3])
+
+    def read(self, retries=100):
+        '''
+        :return:
+            (dict): fields plus published_at and samples_seen; None if nothing published yet or
+            the writer kept the slot busy for every retry
+        '''
+        for _ in range(retries):
+            seq = self.header[0]
+            if seq % 2:
+                continue
+            values = self.values.copy()
+            published_at, samples_seen = self.header[1], self.header[2]
+            if self.header[0] == seq:
+                if seq == 0:
+                    return None
+                output = dict(zip(self.fields, values))
+                output.update({'published_at': published_at, 'samples_seen': int(samples_seen)})
+                return output
+        return None
+
+    def close(self, unlink=False):
+        del self.header, self.values
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def forecast_fields(config=DEFAULT_CONFIG):
+    # time: elapsed seconds at the first forecast period
+    return ['time'] + [f'yhat_{name}' for name in config.horizons] + ['yhat_eta']
+
+
+def hold_last_frame(history, periods):
+    '''
+    Future regressors when no planned route is available: distance keeps growing at the recent
+    speed (mean dist_delta of the last RECENT_PERIODS samples) and the altitude at the recent grade;
+    every other column (e.g., heartrate, temp, alt_delta, alt_forecast) holds its last observed value
+    '''
+    future = RunFrame(periods, start_date=history.start_date)
+    steps = np.arange(1, periods + 1)
+    future.time[:] = history.time[-1] + PERIOD_SECONDS * steps
+    for col in FLOAT_COLUMNS:
+        getattr(future, col)[:] = getattr(history, col)[-1]
+    for col, delta_col in (('distance', 'dist_delta'), ('altitude', 'alt_delta')):
+        recent = getattr(history, delta_col)[-RECENT_PERIODS:]
+        delta = np.nanmean(recent) if np.isfinite(recent).any() else 0.
+        getattr(future, delta_col)[:] = delta
+        getattr(future, col)[:] = getattr(history, col)[-1] + delta * steps
+    return future
+
+
+def forecast_live(history, target, config=DEFAULT_CONFIG, route=None, model=None, position=None):
+    '''
+    Fits on the samples in history and forecasts each horizon
+    :param history:
+        (RunFrame): samples received so far (or the newest of them)
+    :param position:
+        (int): samples received since the start of the run; defaults to len(history). Aligns
+        history with the route when history is a rolling window
+    :param route:
+        (RunFrame): planned route aligned to the run's 5s intervals; supplies future regressors
+        and the total distance for the ETA
+    :param model:
+        fitted Prophet model to forecast with instead of refitting (e.g., restored from a checkpoint)
+    :return:
+        model: the fitted model
+        values (dict): forecast_fields values
+    '''
+    n = len(history)
+    position = n if position is None else position
+    has_route = route is not None and len(route) > position
+    with_eta = config.eta and target == 'pace' and has_route
+    if has_route:
+        stop = len(route) if with_eta else min(len(route), position + config.max_horizon)
+        future = route.window(position, stop)
+    else:
+        future = hold_last_frame(history, config.max_horizon)
+    if model is None:
+        model = fit_model(history, target, n, config)
+    forecast = forecast_model(model, history, target, n, future, config)
+    values = summarize_horizons(forecast, config.horizons)
+    values['time'] = float(history.time[-1] + PERIOD_SECONDS)
+    if with_eta:
+        values['yhat_eta'] = float(route.distance[-1]) / forecast['yhat'].iloc[-1]
+    return model, values
+
+
+def run_worker(ring_name, slot_name, capacity, target, config, start_date=None, route_archive_path=None,
+               route_run_id=None, checkpoint_path=None, session_id=None, poll_interval=.05):
+    '''
+    Worker process loop: read new samples, refit every config.update_period samples, publish.
+    History is a rolling window of the newest capacity samples; refits are scheduled on the ring's
+    sample count (seen), which also locates the window within the run
+    '''
+    ring = SampleRing(capacity, name=ring_name)
+    slot = ForecastSlot(forecast_fields(config), name=slot_name)
+    route = None
+    if route_archive_path is not None:
+        route = RunArchive(route_archive_path).get_run(route_run_id)
+    checkpoint = None
+    model, last_fit = None, None
+    if checkpoint_path is not None:
+        checkpoint = SessionCheckpoint(checkpoint_path, session_id)
+        model, last_fit = checkpoint.load_model()
+        last_fit = last_fit if model is not None else None
+    history = RunFrame(capacity, start_date=start_date)
+    n = 0
+    seen = 0
+    while True:
+        slot.heartbeat()
+        seen, rows = ring.read_since(seen)
+        # drop the oldest samples to make room for the new ones
+        overflow = n + rows.shape[0] - capacity
+        if overflow > 0:
+            keep = max(0, n - overflow)
+            for col in COLUMNS:
+                column = getattr(history, col)
+                column[:keep] = column[n - keep:n]
+            n = keep
+        for i, col in enumerate(COLUMNS):
+            getattr(history, col)[n:n + rows.shape[0]] = rows[:, i]
+        n += rows.shape[0]
+        if model is not None and n and slot.read() is None:
+            # restored model: publish right away, then refit on the usual schedule
+            _, values = forecast_live(history.window(0, n), target, config, route, model, position=seen)
+            slot.publish(values, samples_seen=seen)
+        elif n >= config.train_period and (last_fit is None or seen - last_fit >= config.update_period):
+            model, values = forecast_live(history.window(0, n), target, config, route, position=seen)
+            slot.publish(values, samples_seen=seen)
+            last_fit = seen
+            if checkpoint is not None:
+                checkpoint.save_model(model, seen)
+        elif not rows.shape[0]:
+            time.sleep(poll_interval)
+
+
+class ForecastWorker(object):
+    '''
+    Functions include:
+        * start()/stop(): manage the worker process and shared memory
+        * push(sample): add a 5s sample (dict of RunFrame column -> value)
+        * resume(): reload a checkpointed session before start()
+        * latest(): freshest forecast plus age/stale flags; restarts a crashed or hung worker
+    '''
+    def __init__(self, target='pace', config=DEFAULT_CONFIG, capacity=DEFAULT_CAPACITY, start_date=None,
+                 route_archive_path=None, route_run_id=None, max_age=None, heartbeat_timeout=60,
+                 checkpoint=None):
+        '''
+        :param checkpoint:
+            (SessionCheckpoint): optional; pushed samples and fitted models are saved for resume()
+        '''
+        self.target = target
+        self.config = config
+        self.capacity = capacity
+        self.start_date = np.datetime64('now') if start_date is None else start_date
+        self.route_archive_path = route_archive_path
+        self.route_run_id = route_run_id
+        # a forecast older than two refit periods is stale
+        self.max_age = 2 * config.update_seconds if max_age is None else max_age
+        # heartbeats stop while Prophet is fitting, so allow for the slowest fit
+        self.heartbeat_timeout = heartbeat_timeout
+        self.checkpoint = checkpoint
+        self.ring = SampleRing(capacity)
+        self.slot = ForecastSlot(forecast_fields(config))
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+
+    def start(self):
+        # the previous worker may have been terminated mid-publish
+        self.slot.recover()
+        self.process = Process(
+            target=run_worker,
+            args=(self.ring.name, self.slot.name, self.capacity, self.target, self.config, self.start_date,
+                  self.route_archive_path, self.route_run_id,
+                  None if self.checkpoint is None else self.checkpoint.root,
+                  None if self.checkpoint is None else self.checkpoint.session_id),
+            daemon=True)
+        self.process.start()
+        self.started_at = time.time()
+
+    def restart(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.restarts += 1
+        self.start()
+
+    def check(self):
+        '''
+        Restarts the worker if it exited or its heartbeat is older than heartbeat_timeout
+        '''
+        if self.process is None:
+            return
+        last_beat = self.slot.heartbeat_at
+        if np.isnan(last_beat) or last_beat < self.started_at:
+            last_beat = self.started_at
+        if not self.process.is_alive() or time.time() - last_beat > self.heartbeat_timeout:
+            self.restart()
+
+    def push(self, sample):
+        self.ring.push(sample)
+        if self.checkpoint is not None:
+            self.checkpoint.append_sample(sample)
+
+    def resume(self):
+        '''
+        Reloads checkpointed samples into the ring; call before start(). The worker forecasts from
+        the checkpointed model instead of refitting
+        :return:
+            (int): samples restored
+        '''
+        samples = self.checkpoint.load_samples()
+        tail = samples[-self.capacity:]
+        # the ring only holds the newest capacity samples, but its count stays the run position
+        self.ring.header[0] = samples.shape[0] - tail.shape[0]
+        for row in tail:
+            self.ring.push(dict(zip(COLUMNS, row)))
+        return samples.shape[0]
+
+    def latest(self):
+        '''
+        :return:
+            (dict): forecast_fields values plus age (s), lag (samples pushed since the forecast's
+            data) and stale; None if no forecast is available yet
+        '''
+        self.check()
+        forecast = self.slot.read()
+        if forecast is None:
+            return None
+        forecast['age'] = time.time() - forecast['published_at']
+        forecast['lag'] = self.ring.count - forecast['samples_seen']
+        forecast['stale'] = forecast['age'] > self.max_age or forecast['lag'] > 2 * self.config.update_period
+        return forecast
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.ring.close(unlink=True)
+        self.slot.close(unlink=True)
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+
+def replay_run(run_id, archive_path='../run_archive', target='pace', speed=1., checkpoint_path=None):
+    '''
+    Demo: replays an archived run into the worker (using the run as the planned route) and prints
+    the latest forecast every refit period
+    :param checkpoint_path:
+        (str): optional SessionCheckpoint directory; an interrupted replay continues where it stopped
+    '''
+    run_frame = RunArchive(archive_path).get_run(run_id)
+    checkpoint = None if checkpoint_path is None else SessionCheckpoint(checkpoint_path, run_id)
+    worker = ForecastWorker(target, start_date=run_frame.start_date, route_archive_path=archive_path,
+                            route_run_id=run_id, checkpoint=checkpoint)
+    first = 0 if checkpoint is None else worker.resume()
+    worker.start()
+    try:
+        for i in range(first, len(run_frame)):
+            worker.push({col: getattr(run_frame, col)[i] for col in COLUMNS})
+            if i % DEFAULT_CONFIG.update_period == 0:
+                print(worker.latest())
+            time.sleep(PERIOD_SECONDS / speed)
+    finally:
+        worker.stop()
+    if checkpoint is not None:
+        checkpoint.clear()
+
+
+if __name__ == '__main__':
+    replay_run(int(input('Enter run id:')), speed=float(input('Replay speed (e.g., 10):')),
+               checkpoint_path='../session_checkpoints')
@@ -0,0 +1,240 @@
+import os
+import numpy as np
+import pandas as pd
+
+'''
+Compact GPS track storage and a grid spatial index over every run.
+
+Tracks (5s intervals) are stored as delta-encoded integers: lat/lng are quantized to 1e-5 degrees
+(~1 m), the first point is absolute and every following point is the difference from the previous
+one, so nearly all values are small and compress well (np.savez_compressed).
+
+The spatial index maps grid cells (CELL_DEG degrees) to (run id, row) pairs in sorted arrays, so
+finding every historical pass through a segment is a handful of binary searches.
+
+e.g.:
+    store = GpsTrackStore()
+    passes_df = store.passes_through([(37.7701, -122.4469), (37.7712, -122.4531)])
+'''
+
+SCALE = 1e5
+CELL_DEG = .001
+EARTH_RADIUS_M = 6371000.
+# cell indices are offset so the key is non-negative
+CELL_OFFSET = 2 ** 20
+INDEX_FILE = 'spatial_index.npz'
+# one entry per track point, sorted by cell key; lat/lng are quantized so distances need no track reads
+INDEX_DTYPES = {'keys': np.int64, 'run_ids': np.int64, 'rows': np.int32, 'lat': np.int32, 'lng': np.int32}
+
+
+def encode_track(lat, lng):
+    '''
+    :return:
+        (array): N x 2 int32; row 0 is the absolute quantized position, later rows are deltas
+    '''
+    quantized = np.round(np.column_stack([lat, lng]) * SCALE).astype(np.int64)
+    return np.diff(quantized, axis=0, prepend=0).astype(np.int32)
+
+
+def decode_track(deltas):
+    '''
+    :return:
+        lat, lng (arrays): float64 degrees
+    '''
+    latlng = np.cumsum(deltas.astype(np.int64), axis=0) / SCALE
+    return latlng[:, 0], latlng[:, 1]
+
+
+def cell_keys(lat, lng):
+    i = np.floor(np.asarray(lat) / CELL_DEG).astype(np.int64) + CELL_OFFSET
+    j = np.floor(np.asarray(lng) / CELL_DEG).astype(np.int64) + CELL_OFFSET
+    return (i << 21) | j
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    '''
+    Equirectangular approximation; accurate to well under a meter at segment scale
+    '''
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    x = (lng2 - lng1) * np.cos((lat1 + lat2) / 2)
+    return EARTH_RADIUS_M * np.hypot(x, lat2 - lat1)
+
+
+def densify(segment, spacing_m):
+    '''
+    Interpolates points along a polyline so consecutive points are at most spacing_m apart
+    '''
+    segment = np.asarray(segment, dtype=np.float64)
+    points = [segment[:1]]
+    for start, end in zip(segment[:-1], segment[1:]):
+        steps = max(1, int(np.ceil(distance_m(*start, *end) / spacing_m)))
+        frac = np.arange(1, steps + 1)[:, None] / steps
+        points.append(start + (end - start) * frac)
+    return np.vstack(points)
+
+
+class GpsTrackStore(object):
+    '''
+    Functions include:
+        * add_track(run_id, lat, lng, **values): store a run and index it
+        * get_track(run_id): decoded lat/lng plus stored values (e.g., pace, cadence)
+        * nearby(lat, lng, radius_m): (run id, row) pairs within radius_m of a point
+        * passes_through(segment): every historical pass through a segment with avg pace/cadence
+    '''
+    def __init__(self, path='../gps_tracks'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.load_index()
+
+    def track_path(self, run_id):
+        return os.path.join(self.path, f'{run_id}.npz')
+
+    def load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with np.load(index_path) as index:
+                self.index = {k: index[k] for k in INDEX_DTYPES}
+        else:
+            self.index = {k: np.array([], dtype=dtype) for k, dtype in INDEX_DTYPES.items()}
+        # (run id, entries) added with save_index=False, merged into the index in one sort by merge_pending()
+        self.pending = []
+        # decoded tracks read by passes_through
+        self.tracks = {}
+
+    def merge_pending(self):
+        '''
+        Merges buffered entries into the index: previous entries of re-added runs are dropped, then
+        one concatenate and one sort for the whole batch
+        '''
+        if not self.pending:
+            return
+        # a run added twice in one batch keeps its last entries
+        latest = dict(self.pending)
+        keep = ~np.isin(self.index['run_ids'], list(latest))
+        merged = {k: np.concatenate([self.index[k][keep]] + [entries[k] for entries in latest.values()])
+                  for k in INDEX_DTYPES}
+        order = np.argsort(merged['keys'], kind='stable')
+        self.index = {k: v[order] for k, v in merged.items()}
+        self.pending = []
+
+    def save_index(self):
+        self.merge_pending()
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = f'{index_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **self.index)
+        os.replace(tmp_path, index_path)
+
+    def __contains__(self, run_id):
+        return os.path.exists(self.track_path(run_id))
+
+    def __len__(self):
+        self.merge_pending()
+        return np.unique(self.index['run_ids']).size
+
+    def add_track(self, run_id, lat, lng, save_index=True, **values):
+        '''
+        :param lat/lng:
+            (arrays): positions at 5s intervals
+        :param values:
+            per-row arrays stored alongside the track (e.g., pace=..., cadence=...); kept as float32
+        :param save_index:
+            (bool): set False when adding many runs and call save_index() once at the end; entries are
+            buffered and merged with a single sort then (or at the next query)
+        '''
+        encoded = encode_track(lat, lng)
+        values = {k: np.asarray(v, dtype=np.float32) for k, v in values.items()}
+        np.savez_compressed(self.track_path(run_id), latlng=encoded, **values)
+        self.tracks.pop(run_id, None)
+        quantized = np.cumsum(encoded, axis=0, dtype=np.int64).astype(np.int32)
+        entries = {
+            'keys': cell_keys(lat, lng),
+            'run_ids': np.full(len(encoded), run_id, dtype=np.int64),
+            'rows': np.arange(len(encoded), dtype=np.int32),
+            'lat': quantized[:, 0],
+            'lng': quantized[:, 1],
+        }
+        self.pending.append((run_id, entries))
+        if save_index:
+            self.save_index()
+
+    def get_track(self, run_id):
+        if run_id not in self.tracks:
+            with np.load(self.track_path(run_id)) as data:
+                track = {k: data[k] for k in data.files}
+            track['lat'], track['lng'] = decode_track(track.pop('latlng'))
+            self.tracks[run_id] = track
+        return self.tracks[run_id]
+
+    def candidates(self, lat, lng, radius_m):
+        '''
+        Index entries in every grid cell within radius_m of the point
+        :return:
+            (array): positions into the index arrays
+        '''
+        lat_cells = int(np.ceil(radius_m / (EARTH_RADIUS_M * np.radians(CELL_DEG))))
+        lng_cells = int(np.ceil(lat_cells / max(np.cos(np.radians(lat)), .01)))
+        center = cell_keys(lat, lng)
+        hits = []
+        for di in range(-lat_cells, lat_cells + 1):
+            for dj in range(-lng_cells, lng_cells + 1):
+                key = center + (di << 21) + dj
+                lo, hi = np.searchsorted(self.index['keys'], [key, key + 1])
+                if hi > lo:
+                    hits.append(np.arange(lo, hi))
+        return np.concatenate(hits) if hits else np.array([], dtype=np.int64)
+
+    def nearby(self, lat, lng, radius_m=25):
+        '''
+        :return:
+            (dataframe): run_id, row, distance_m for every indexed point within radius_m
+        '''
+        hit_idx, dist = self.nearby_points(np.array([[lat, lng]]), radius_m)
+        return pd.DataFrame({'run_id': self.index['run_ids'][hit_idx], 'row': self.index['rows'][hit_idx],
+                             'distance_m': dist.min(axis=1)})
+
+    def nearby_points(self, points, radius_m):
+        '''
+        :return:
+            hit_idx (array): index positions within radius_m of any point
+            dist (array): len(hit_idx) x len(points) distances in meters
+        '''
+        self.merge_pending()
+        hit_idx = np.unique(np.concatenate([self.candidates(lat, lng, radius_m) for lat, lng in points]))
+        lat = self.index['lat'][hit_idx, None] / SCALE
+        lng = self.index['lng'][hit_idx, None] / SCALE
+        dist = distance_m(lat, lng, points[None, :, 0], points[None, :, 1]).reshape(hit_idx.size, len(points))
+        within = dist.min(axis=1) <= radius_m
+        return hit_idx[within], dist[within]
+
+    def passes_through(self, segment, radius_m=25, max_gap=2):
+        '''
+        Historical passes through a segment: consecutive rows of a run within radius_m of the segment
+        that reach both its start and its end
+        :param segment:
+            (list): (lat, lng) points of the segment polyline
+        :param max_gap:
+            (int): rows a pass may stray from the segment (GPS noise) before it is split
+        :return:
+            (dataframe): run_id, start_row, stop_row plus the mean of every stored value (e.g., pace)
+        '''
+        points = densify(segment, radius_m)
+        hit_idx, dist = self.nearby_points(points, radius_m)
+        run_ids, rows = self.index['run_ids'][hit_idx], self.index['rows'][hit_idx]
+        order = np.lexsort((rows, run_ids))
+        run_ids, rows, nearest = run_ids[order], rows[order], dist.argmin(axis=1)[order]
+        # a new pass starts at every run change or gap in rows
+        starts = np.flatnonzero(np.r_[True, (np.diff(run_ids) != 0) | (np.diff(rows) > max_gap + 1)])
+        stops = np.r_[starts[1:], len(rows)]
+        complete = np.zeros(len(starts), dtype=bool)
+        if len(rows):
+            complete = (np.minimum.reduceat(nearest, starts) == 0) & \
+                       (np.maximum.reduceat(nearest, starts) == len(points) - 1)
+        output = []
+        for start, stop in zip(starts[complete], stops[complete]):
+            run_id = int(run_ids[start])
+            row = {'run_id': run_id, 'start_row': int(rows[start]), 'stop_row': int(rows[stop - 1]) + 1}
+            for k, v in self.get_track(run_id).items():
+                if k not in ('lat', 'lng'):
+                    row[k] = float(np.nanmean(v[row['start_row']:row['stop_row']]))
+            output.append(row)
+        return pd.DataFrame(output, columns=None if output else ['run_id', 'start_row', 'stop_row'])
@@ -0,0 +1,351 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import pandas as pd
+
+from fbp_model import walk_forward_forecast
+from fbp_tuning import build_config, grid_configs, random_configs
+from forecast_config import DEFAULT_CONFIG, ForecastConfig, MODEL_VERSION
+from results_store import ResultsStore, DEFAULT_ATHLETE
+from run_archive import RunArchive
+
+''' Filesystem job queue for spreading backtests/tuning across machines that share a directory (e.g., NFS)
+
+Each task is one (run_id, config) walk-forward forecast. Layout of the queue directory:
+    * tasks/<shard>/<task_id>.json: task definition (written once)
+    * leases/<task_id>.lease: owner and lease length; created with O_EXCL so only one worker claims a
+      task. The lease expires lease_seconds after the file's mtime
+    * done/<task_id>.json, failed/<task_id>.json: completion markers
+
+Workers renew their lease while fitting by touching its mtime; the file is never rewritten, so a late
+renew cannot replace a lease another worker took over. A lease that is not renewed (worker crashed or
+machine went down) expires and the task is claimed again: the expired lease is renamed away first,
+which only one worker can do, and put back if it turns out to have been renewed or replaced since it
+was read. Expiry is compared against each machine's clock, so machines should run NTP.
+
+Results are written to the shared ResultsStore as one part per task, only after the task completes.
+No broker is needed; any number of workers can be started on any machine:
+    queue = JobQueue('/mnt/shared/job_queue')
+    queue.submit(run_ids, [DEFAULT_CONFIG])
+    queue.work('/mnt/shared/run_archive', '/mnt/shared/results_store')  # on every machine
+'''
+
+N_SHARDS = 16
+LEASE_SECONDS = 600
+
+
+def task_id(task):
+    return hashlib.sha1(json.dumps(task, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def config_version(config, model_version=MODEL_VERSION):
+    '''
+    Results store model_version for a non-default config (one partition per config)
+    '''
+    if config.to_dict() == DEFAULT_CONFIG.to_dict():
+        return model_version
+    return f'{model_version}_{task_id(config.to_dict())[:8]}'
+
+
+def write_json(path, data):
+    # write then rename so readers never see a partial file
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        # missing or partially written
+        return None
+
+
+def read_lease(path):
+    '''
+    :return:
+        (dict): lease contents plus expires_at (mtime + lease_seconds); None if missing or still
+        being written
+    '''
+    try:
+        with open(path) as f:
+            lease = json.load(f)
+            mtime = os.fstat(f.fileno()).st_mtime
+    except (FileNotFoundError, ValueError):
+        return None
+    return dict(lease, expires_at=mtime + lease['lease_seconds'])
+
+
+class JobQueue(object):
+    '''
+    Functions include:
+        * submit(run_ids, configs): add (run_id, config) tasks; resubmitting a task is a no-op
+        * submit_search(space, run_ids): tasks for a hyperparameter search (see fbp_tuning)
+        * claim()/complete()/fail(): lease protocol used by work()
+        * work(archive_path, store_path): worker loop; run on as many machines as needed
+        * status(): pending/leased/done/failed counts
+    '''
+    def __init__(self, path='../job_queue', lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        for sub in ['leases', 'done', 'failed'] + [os.path.join('tasks', f'{i:02x}') for i in range(N_SHARDS)]:
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def task_path(self, tid):
+        return os.path.join(self.path, 'tasks', f'{int(tid[:2], 16) % N_SHARDS:02x}', f'{tid}.json')
+
+    def lease_path(self, tid):
+        return os.path.join(self.path, 'leases', f'{tid}.lease')
+
+    def marker_path(self, kind, tid):
+        return os.path.join(self.path, kind, f'{tid}.json')
+
+    def submit(self, run_ids, configs, target='pace', model_version=MODEL_VERSION, athlete=DEFAULT_ATHLETE,
+               uncertainty='off'):
+        '''
+        :param configs:
+            (list): ForecastConfig for each variant; each non-default config gets its own
+            model_version partition (see config_version)
+        :return:
+            (list): ids of newly added tasks
+        '''
+        added = []
+        for config in configs:
+            for run_id in run_ids:
+                task = {'run_id': int(run_id), 'target': target, 'config': config.to_dict(),
+                        'model_version': config_version(config, model_version), 'athlete': athlete,
+                        'uncertainty': uncertainty}
+                tid = task_id(task)
+                if not os.path.exists(self.task_path(tid)):
+                    write_json(self.task_path(tid), task)
+                    added.append(tid)
+        return added
+
+    def submit_search(self, space, run_ids, target='pace', method='random', n_trials=20, random_state=444):
+        '''
+        Every (config, run) pair of a grid or random search; rank with
+        ResultsStore.error_metrics(by=('model_version',)) once done
+        '''
+        params = grid_configs(space) if method == 'grid' else random_configs(space, n_trials, random_state)
+        return self.submit(run_ids, [build_config(p) for p in params], target, uncertainty='analytic')
+
+    def task_ids(self):
+        return [name[:-len('.json')] for shard in sorted(os.listdir(os.path.join(self.path, 'tasks')))
+                for name in os.listdir(os.path.join(self.path, 'tasks', shard)) if name.endswith('.json')]
+
+    def is_finished(self, tid):
+        return os.path.exists(self.marker_path('done', tid)) or os.path.exists(self.marker_path('failed', tid))
+
+    def try_lease(self, tid):
+        '''
+        :return:
+            (bool): True if this worker now holds the lease
+        '''
+        lease_path = self.lease_path(tid)
+        lease = read_lease(lease_path)
+        if lease is not None:
+            if lease['expires_at'] > time.time() or not self.remove_lease(tid, lease):
+                return False
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'claimed_at': time.time(), 'lease_seconds': self.lease_seconds}, f)
+        return True
+
+    def remove_lease(self, tid, lease):
+        '''
+        Removes the lease only if it is still the one that was read: it is renamed away first (only
+        one worker can), then compared, and put back if it was renewed or replaced in between
+        :return:
+            (bool): True if the lease was removed
+        '''
+        lease_path = self.lease_path(tid)
+        removed_path = f'{lease_path}.{self.owner.replace(":", "-")}.expired'
+        try:
+            os.rename(lease_path, removed_path)
+        except FileNotFoundError:
+            return False
+        if read_lease(removed_path) == lease:
+            os.remove(removed_path)
+            return True
+        try:
+            # link fails instead of overwriting if a new lease was created while the path was free
+            os.link(removed_path, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(removed_path)
+        return False
+
+    def holds_lease(self, tid):
+        lease = read_lease(self.lease_path(tid))
+        return lease is not None and lease['owner'] == self.owner
+
+    def renew(self, tid):
+        '''
+        Extends the lease by touching its mtime, so a renew racing a takeover can only extend the
+        other worker's lease, never replace it
+        :return:
+            (bool): False if the lease was lost (expired and claimed by another worker)
+        '''
+        if not self.holds_lease(tid):
+            return False
+        try:
+            os.utime(self.lease_path(tid))
+        except FileNotFoundError:
+            return False
+        # taken over between the check and the touch
+        return self.holds_lease(tid)
+
+    def release(self, tid):
+        lease = read_lease(self.lease_path(tid))
+        if lease is not None and lease['owner'] == self.owner:
+            self.remove_lease(tid, lease)
+
+    def claim(self):
+        '''
+        Leases the next unfinished task. Shards are scanned from a random start so workers rarely
+        race for the same task
+        :return:
+            (tuple): (task id, task dict); None if every task is finished or leased
+        '''
+        shards = sorted(os.listdir(os.path.join(self.path, 'tasks')))
+        start = random.randrange(len(shards))
+        for shard in shards[start:] + shards[:start]:
+            names = os.listdir(os.path.join(self.path, 'tasks', shard))
+            random.shuffle(names)
+            for name in names:
+                tid = name[:-len('.json')]
+                if not name.endswith('.json') or self.is_finished(tid):
+                    continue
+                if self.try_lease(tid):
+                    # finished between the check and the lease
+                    if self.is_finished(tid):
+                        self.release(tid)
+                        continue
+                    return tid, read_json(self.task_path(tid))
+        return None
+
+    def complete(self, tid, seconds=None):
+        '''
+        :return:
+            (bool): False if the lease was lost to another worker, which then completes the task
+        '''
+        if not self.holds_lease(tid):
+            return False
+        write_json(self.marker_path('done', tid), {'owner': self.owner, 'seconds': seconds, 'at': time.time()})
+        self.release(tid)
+        return True
+
+    def fail(self, tid, error):
+        write_json(self.marker_path('failed', tid), {'owner': self.owner, 'error': error, 'at': time.time()})
+        self.release(tid)
+
+    def retry_failed(self):
+        '''
+        Clears failed markers so the tasks are claimed again
+        '''
+        for name in os.listdir(os.path.join(self.path, 'failed')):
+            os.remove(os.path.join(self.path, 'failed', name))
+
+    def status(self):
+        '''
+        :return:
+            (dict): task counts by state
+        '''
+        tids = self.task_ids()
+        done = {n[:-len('.json')] for n in os.listdir(os.path.join(self.path, 'done'))}
+        failed = {n[:-len('.json')] for n in os.listdir(os.path.join(self.path, 'failed'))}
+        leased = {n[:-len('.lease')] for n in os.listdir(os.path.join(self.path, 'leases')) if n.endswith('.lease')}
+        return {
+            'tasks': len(tids),
+            'done': len(done),
+            'failed': len(failed),
+            'leased': len(leased - done - failed),
+            'pending': len(set(tids) - done - failed - leased),
+        }
+
+    def run_task(self, tid, task, archive, store):
+        '''
+        Walk-forward forecast for one task while a background thread renews the lease
+        :return:
+            (bool): True if this worker completed the task; False if the lease was lost
+        '''
+        stop = threading.Event()
+
+        def keep_lease():
+            while not stop.wait(self.lease_seconds / 3):
+                if not self.renew(tid):
+                    return
+
+        renewer = threading.Thread(target=keep_lease, daemon=True)
+        renewer.start()
+        start = time.perf_counter()
+        try:
+            run_frame = archive.get_run(task['run_id'])
+            result_df = walk_forward_forecast(run_frame, task['target'], ForecastConfig(**task['config']),
+                                              task['uncertainty'], progress=False)
+        finally:
+            stop.set()
+            renewer.join()
+        # another worker took over an expired lease; let it write the results
+        if not self.holds_lease(tid) or self.is_finished(tid):
+            return False
+        # one part named after the task, so a rerun (e.g., after a lost lease) replaces it
+        store.write(result_df, task['model_version'], task['target'], task['athlete'], task['run_id'], part_id=tid)
+        return self.complete(tid, time.perf_counter() - start)
+
+    def work(self, archive_path='../run_archive', store_path='../results_store', max_tasks=None,
+             wait_for_tasks=False, poll_interval=30):
+        '''
+        Worker loop: claim, run and complete tasks until none are left
+        :param wait_for_tasks:
+            (bool): keep polling for new tasks instead of exiting when the queue is drained
+        :return:
+            (int): tasks completed by this worker
+        '''
+        archive = RunArchive(archive_path)
+        store = ResultsStore(store_path)
+        completed = 0
+        while max_tasks is None or completed < max_tasks:
+            claimed = self.claim()
+            if claimed is None:
+                if not wait_for_tasks:
+                    break
+                time.sleep(poll_interval)
+                continue
+            tid, task = claimed
+            # pick up runs appended by other machines since the archive was opened
+            if task['run_id'] not in archive:
+                archive.refresh()
+            try:
+                done = self.run_task(tid, task, archive, store)
+            except Exception:
+                self.fail(tid, traceback.format_exc())
+                continue
+            if done:
+                completed += 1
+            else:
+                print(f'Lost the lease on task {tid} to another worker')
+        return completed
+
+
+if __name__ == '__main__':
+    queue = JobQueue(input('Enter queue directory (e.g., ../job_queue):'))
+    mode = input('Enter mode (submit/work/status):')
+    if mode == 'submit':
+        archive = RunArchive(input('Enter archive directory (e.g., ../run_archive):'))
+        print(f'Added {len(queue.submit(archive.run_ids, [DEFAULT_CONFIG]))} tasks')
+    elif mode == 'work':
+        print(f"Completed {queue.work(input('Enter archive directory:'), input('Enter results store directory:'))} tasks")
+    print(pd.Series(queue.status()).to_string())
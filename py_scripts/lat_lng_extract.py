@@ -1,12 +1,19 @@
+import time
 import pandas as pd
+from tqdm import tqdm
 from strava_api_calls_v2 import *
 from strava_cfg import *
+from gps_index import GpsTrackStore
 
 '''
-File to export GPS coordinates for runs
+File to export GPS coordinates for runs into the GpsTrackStore (delta-encoded tracks plus a
+spatial index across all runs, see gps_index)
 TODO: This could likely be made a child class of process_strava_data
 '''
 
+# Strava stream keys used by setup_input; request only these in get_route_stream
+STREAM_KEYS = ['time', 'distance', 'latlng', 'altitude', 'cadence', 'temp']
+
 class Strava_single_run_data(object):
 
     def __init__(self, raw_strava_df):
@@ -41,21 +48,20 @@ class Strava_single_run_data(object):
         :param input_df:
             Activity stream from Strava
         :return:
-            dataframe with temp, time, cadence, distance, altitude, heartrate,
+            dataframe with temp, time, cadence, distance, altitude, lat, lng,
             and calculated pace using device reported distance
         '''
         features = ['temp', 'time','cadence', 'distance', 'altitude',
-                    'heartrate', 'pace', 'lat', 'lng']
+                    'pace', 'lat', 'lng']
         self.EDA_df = self.raw_strava_df.copy()
-        if not self.EDA_df['latlng'].apply(lambda x: type(x) == list).any():
-        # latlng data imported as string vs. list in some instances
-            self.EDA_df['latlng'] = self.EDA_df['latlng'].str.strip('[]').str.split(',')
-            self.EDA_df['latlng'] = self.EDA_df['latlng'].apply(lambda x: [float(item) for item in x])
+        if 'lat' not in self.EDA_df.columns:
+            # older saved streams (e.g., raw_data csv) have a latlng column of strings/lists
+            latlng = self.EDA_df['latlng'].astype(str).str.strip('[]').str.split(',', expand=True)
+            self.EDA_df['lat'] = latlng[0].astype(float)
+            self.EDA_df['lng'] = latlng[1].astype(float)
 
         self.EDA_df['pace'] = self.EDA_df['distance'] / self.EDA_df['time']
         self.EDA_df['pace'].fillna(0, inplace=True)
-        self.EDA_df['lat'] = self.EDA_df['latlng'].apply(lambda x: x[0])
-        self.EDA_df['lng'] = self.EDA_df['latlng'].apply(lambda x: x[1])
         self.EDA_df = self.EDA_df[features][1:]
         return self.EDA_df[1:]
 
@@ -78,7 +84,7 @@ class Strava_single_run_data(object):
             # grab raw data available immediately before and after missing 5s interval
             temp_df = self.EDA_df.iloc[(self.EDA_df['time'] - x).abs().argsort()[:2]]
             index = self.trans_df[self.trans_df['5s_intervals'] == x].index
-            avg_cols = ['temp', 'cadence', 'heartrate', 'pace', 'altitude', 'lat', 'lng']
+            avg_cols = ['temp', 'cadence', 'pace', 'altitude', 'lat', 'lng']
             wtd_avg_col = ['distance']
             for cols in avg_cols:
                 # take simple mean to estimate metrics at missing 5s measurements
@@ -115,12 +121,60 @@ class Strava_single_run_data(object):
         self.add_feat_df['alt_forecast'] = self.alt_delta_forecast(self.add_feat_df['alt_delta'])
         return self.add_feat_df
 
-if __name__ == '__main__':
-    run_activity = int(input('Enter run id:'))
-    client = StravaAPI(client_id, client_secret, refresh_token)
-    sample_1 = client.get_route_stream(run_activity)
-    latlng_ex = Strava_single_run_data(sample_1)
+def process_gps_run(raw_strava_df):
+    '''
+    :return:
+        (dataframe): 5s intervals with lat, lng, pace and cadence; None if the run has no GPS (e.g., treadmill)
+    '''
+    if 'lat' not in raw_strava_df.columns and 'latlng' not in raw_strava_df.columns:
+        return None
+    latlng_ex = Strava_single_run_data(raw_strava_df)
     latlng_ex.setup_input()
-    latlng_ex.extract_5s_increments()
     latlng_ex.combine_t_inc_raw()
-    latlng_ex.processed_df.to_csv(f'../raw_data/lat_lng_extract_{run_activity}.csv')
\ No newline at end of file
+    processed_df = latlng_ex.processed_df
+    # GPS dropouts hold the nearest fix
+    processed_df[['lat', 'lng']] = processed_df[['lat', 'lng']].ffill().bfill()
+    if processed_df['lat'].isna().any():
+        return None
+    return processed_df
+
+
+def export_gps_tracks(store=None, chosen_run_ids=None, replace=False, stream_cache=None):
+    '''
+    Batch export of GPS tracks for every run not in the store yet. The spatial index is saved once
+    at the end (and after any failure) instead of per run
+    :param store:
+        (GpsTrackStore): defaults to GpsTrackStore() at ../gps_tracks
+    :param chosen_run_ids:
+        (list): Strava run ids; if none provided, all runs in the activity list
+    :param replace:
+        (bool): re-export runs that are already in the store
+    :return:
+        (GpsTrackStore): updated store
+    '''
+    if store is None:
+        store = GpsTrackStore()
+    client = StravaAPI(client_id, client_secret, refresh_token, stream_cache)
+    run_list = list(client.activity_list['id'])
+    run_ids = run_list if chosen_run_ids is None else [x for x in chosen_run_ids if x in run_list]
+    try:
+        for run_id in tqdm([x for x in run_ids if replace or x not in store]):
+            try:
+                processed_df = process_gps_run(client.get_route_stream(run_id, keys=STREAM_KEYS))
+            except Exception:
+                client.error_log.append(run_id)
+                continue
+            if processed_df is not None:
+                store.add_track(run_id, processed_df['lat'].values, processed_df['lng'].values,
+                                save_index=False, pace=processed_df['pace'].values,
+                                cadence=processed_df['cadence'].values)
+            # stay under Strava rate limits
+            time.sleep(10)
+    finally:
+        store.save_index()
+    return store
+
+
+if __name__ == '__main__':
+    store = export_gps_tracks()
+    print(f'{len(store)} runs indexed in {store.path}')
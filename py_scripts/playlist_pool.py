@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from urllib.parse import urlencode
+
+''' Builds the candidate song pool for music selection from several searches and playlists
+
+Requests run in stages (searches, first playlist pages, remaining pages, audio features), each
+spread over one shared thread pool, and responses are cached on disk. A cached response is
+used as-is while younger than the TTL; after that it is revalidated with its ETag (If-None-Match),
+so unchanged playlists cost a 304 instead of a full download.
+
+e.g.:
+    builder = PlaylistPoolBuilder(spc)
+    edm_af = builder.build(queries=['EDM 150 bpm'], playlist_ids=['3YgpDQqiu3hSEyRczMvJ9F'])
+'''
+
+API_URL = 'https://api.spotify.com/v1'
+PAGE_LIMIT = 100            # max tracks per playlist page
+AUDIO_FEATURES_LIMIT = 100  # max ids per audio-features request
+
+
+class ResponseCache(object):
+    '''
+    One JSON file per URL: body, ETag and fetch time
+    '''
+    def __init__(self, path='../spotify_cache', ttl=24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def load(self, url):
+        entry_path = self.entry_path(url)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path) as f:
+            return json.load(f)
+
+    def save(self, url, body, etag=None):
+        entry_path = self.entry_path(url)
+        tmp_path = f'{entry_path}.{os.getpid()}.{time.time_ns()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'url': url, 'etag': etag, 'fetched_at': time.time(), 'body': body}, f)
+        os.replace(tmp_path, entry_path)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+
+class PlaylistPoolBuilder(object):
+    '''
+    Functions include:
+        * search_playlist_ids(query): playlist ids for a search
+        * get_playlist_tracks(playlist_id): every track on a playlist (all pages)
+        * get_playlists_tracks(playlist_ids): same for many playlists, one batch per page stage
+        * get_audio_features(track_ids): audio features dataframe
+        * build(queries, playlist_ids): deduplicated, tempo-covered candidate pool
+    '''
+    def __init__(self, spc, cache=None, max_workers=8, max_retries=3):
+        '''
+        :param spc:
+            SpotifyAPI instance (used for auth headers)
+        :param cache:
+            (ResponseCache): defaults to ResponseCache() at ../spotify_cache; False disables caching
+        '''
+        self.spc = spc
+        self.cache = ResponseCache() if cache is None else cache
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        # shared executor while build() runs
+        self.pool = None
+        # (url, error) for requests that failed after every retry
+        self.error_log = []
+
+    def get_json(self, url):
+        '''
+        GET with caching, ETag revalidation and Retry-After handling for rate limits
+        :return:
+            (dict): response body; raises if the request still fails after max_retries
+        '''
+        entry = self.cache.load(url) if self.cache else None
+        if entry is not None and self.cache.is_fresh(entry):
+            return entry['body']
+        headers = self.spc.get_resource_header()
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        for _ in range(self.max_retries):
+            r = self.session.get(url, headers=headers)
+            if r.status_code != 429:
+                break
+            time.sleep(int(r.headers.get('Retry-After', 1)))
+        if r.status_code == 304 and entry is not None:
+            self.cache.save(url, entry['body'], entry['etag'])
+            return entry['body']
+        if r.status_code not in range(200, 300):
+            raise Exception(f'Spotify request failed ({r.status_code}): {url}')
+        body = r.json()
+        if self.cache:
+            self.cache.save(url, body, r.headers.get('ETag'))
+        return body
+
+    def map(self, func, items):
+        if self.pool is not None:
+            return list(self.pool.map(func, items))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(func, items))
+
+    def fetch_all(self, urls):
+        '''
+        GETs urls concurrently; failures are recorded in error_log
+        :return:
+            (list): response bodies in url order; None for failed requests
+        '''
+        def fetch(url):
+            try:
+                return self.get_json(url)
+            except Exception as e:
+                self.error_log.append((url, repr(e)))
+                return None
+        return self.map(fetch, urls)
+
+    def search_url(self, query, limit=5):
+        return f"{API_URL}/search?{urlencode({'q': query, 'type': 'playlist', 'limit': limit})}"
+
+    def search_playlist_ids(self, query, limit=5):
+        items = self.get_json(self.search_url(query, limit)).get('playlists', {}).get('items', [])
+        return [item['id'] for item in items if item]
+
+    def get_playlists_tracks(self, playlist_ids):
+        '''
+        :return:
+            (dict): playlist id -> track dicts. First pages give each total; every remaining page is
+            then fetched in one batch. Playlists with a failed page are skipped (see error_log)
+        '''
+        def page_url(playlist_id, offset):
+            return f'{API_URL}/playlists/{playlist_id}/tracks?limit={PAGE_LIMIT}&offset={offset}'
+        first_pages = self.fetch_all([page_url(playlist_id, 0) for playlist_id in playlist_ids])
+        rest = [(playlist_id, offset) for playlist_id, page in zip(playlist_ids, first_pages) if page is not None
+                for offset in range(PAGE_LIMIT, page.get('total', 0), PAGE_LIMIT)]
+        rest_pages = self.fetch_all([page_url(*key) for key in rest])
+        pages = {playlist_id: [page] for playlist_id, page in zip(playlist_ids, first_pages)}
+        for (playlist_id, _), page in zip(rest, rest_pages):
+            pages[playlist_id].append(page)
+        return {playlist_id: [item['track'] for page in playlist_pages for item in page.get('items', [])
+                              if item.get('track')]
+                for playlist_id, playlist_pages in pages.items() if None not in playlist_pages}
+
+    def get_playlist_tracks(self, playlist_id):
+        '''
+        :return:
+            (list): track dicts for every page of the playlist
+        '''
+        tracks = self.get_playlists_tracks([playlist_id])
+        if playlist_id not in tracks:
+            raise Exception(f'Could not load playlist {playlist_id}: {self.error_log[-1][1]}')
+        return tracks[playlist_id]
+
+    def get_audio_features(self, track_ids):
+        '''
+        :return:
+            (dataframe): one row per track with audio features (tempo, duration_ms, uri, ...);
+            raises if a batch fails since the pool's tempo bins would be skewed
+        '''
+        batches = [track_ids[i:i + AUDIO_FEATURES_LIMIT] for i in range(0, len(track_ids), AUDIO_FEATURES_LIMIT)]
+        responses = self.fetch_all([f"{API_URL}/audio-features?ids={','.join(batch)}" for batch in batches])
+        failed = sum(body is None for body in responses)
+        if failed:
+            raise Exception(f'{failed} of {len(batches)} audio feature requests failed: {self.error_log[-1][1]}')
+        features = [songs for body in responses for songs in body.get('audio_features', []) if songs]
+        return pd.DataFrame(features)
+
+    def build(self, queries=(), playlist_ids=(), playlists_per_query=5, tempo_range=None, bins=3,
+              min_per_bin=5):
+        '''
+        :param queries:
+            (list): playlist searches (e.g., 'EDM 150 bpm')
+        :param playlist_ids:
+            (list): playlists to include directly
+        :param tempo_range:
+            (tuple): (min, max) bpm to keep; None keeps every tempo
+        :param bins/min_per_bin:
+            the pool must have at least bins * min_per_bin tracks so every tempo bin
+            (see process_audio_features) has candidates
+        :return:
+            (dataframe): audio features for the deduplicated pool plus track name
+        '''
+        # make sure the token is valid before threads start requesting headers
+        self.spc.get_access_token()
+        self.error_log = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            self.pool = pool
+            try:
+                ids = list(playlist_ids)
+                for body in self.fetch_all([self.search_url(query, playlists_per_query) for query in queries]):
+                    items = [] if body is None else body.get('playlists', {}).get('items', [])
+                    ids += [item['id'] for item in items if item]
+                ids = list(dict.fromkeys(ids))
+                tracks = {}
+                for playlist_tracks in self.get_playlists_tracks(ids).values():
+                    for track in playlist_tracks:
+                        # local files have no id and no audio features
+                        if track.get('id') and not track.get('is_local'):
+                            tracks.setdefault(track['id'], track['name'])
+                pool_df = self.get_audio_features(list(tracks))
+            finally:
+                self.pool = None
+        if self.error_log:
+            print(f'{len(self.error_log)} Spotify requests failed; their searches/playlists were skipped (see error_log)')
+        if pool_df.empty:
+            raise Exception('No tracks found for the given queries/playlists')
+        pool_df['name'] = pool_df['id'].map(tracks)
+        if tempo_range is not None:
+            pool_df = pool_df[pool_df['tempo'].between(*tempo_range)]
+        if pool_df.shape[0] < bins * min_per_bin:
+            raise Exception(f'Only {pool_df.shape[0]} tracks in the pool; need {bins * min_per_bin} to cover {bins} tempo bins')
+        return pool_df.reset_index(drop=True)
@@ -5,14 +5,16 @@ from scipy import stats
 
 from strava_api_calls_v2 import *
 from process_strava_data import *
+from run_frame import RunFrame
+from run_archive import RunArchive
 
 class fbp_data_prep(StravaAPI):
     '''
     Instance of StravaAPI class. StravaAPI has multiple functions for querying data.
     '''
 
-    def __init__(self, client_id, client_secret, refresh_token, run_id, *args, **kwargs):
-        super().__init__(client_id, client_secret, refresh_token)
+    def __init__(self, client_id, client_secret, refresh_token, run_id, stream_cache=None, *args, **kwargs):
+        super().__init__(client_id, client_secret, refresh_token, stream_cache)
         # run_list contains all run data; may not be needed
         self.run_list = self.get_run_list()
         self.activity_list = super().get_activity_list()
@@ -61,12 +63,39 @@ class fbp_data_prep(StravaAPI):
             sample_run = self.run_id
         else:
             sample_run = random.choice(train_list)
-        run_info = super().get_route_stream(sample_run)
-        #run_info.to_csv(f'../raw_data/raw_run_data{sample_run}.csv')
-        # filter extreme outliers ( |z| > 10)
-        run_info = run_info[np.abs(stats.zscore(run_info['cadence'])) < 10]
+        run_info = self.get_filtered_route_stream(sample_run)
         return sample_run, run_info
 
+    def get_filtered_route_stream(self, run_id):
+        '''
+        Route stream for a run with extreme cadence outliers removed
+        :return:
+            run_info (dataframe): runstream data from Strava in dataframe format
+        '''
+        run_info = super().get_route_stream(run_id, keys=STREAM_KEYS)
+        #run_info.to_csv(f'../raw_data/raw_run_data{run_id}.csv')
+        return filter_route_stream(run_info)
+
+    def get_run_date(self, run_id):
+        return self.activity_list[self.activity_list['id'] == run_id]['start_date']
+
+def filter_route_stream(run_info):
+    '''
+    Removes extreme cadence outliers ( |z| > 10) from a route stream
+    '''
+    return run_info[np.abs(stats.zscore(run_info['cadence'])) < 10]
+
+def process_activity(strava, run_id, run_date):
+    '''
+    Downloads and processes one run with an existing StravaAPI client. Errors are raised
+    :param run_date:
+        activity start date (series from activity_list or a timestamp)
+    :return:
+        (RunFrame): 5s interval data for the run
+    '''
+    run_info = filter_route_stream(strava.get_route_stream(run_id, keys=STREAM_KEYS))
+    return process_streams(run_info, run_id=run_id, run_date=run_date)
+
 def process_data(chosen_run_id):
     '''
     Process data and attach run date
@@ -80,14 +109,70 @@ def process_data(chosen_run_id):
     # for test_class, input a run_id argument if we want to see a specific run_id
     test_class = fbp_data_prep(client_id, client_secret, refresh_token, chosen_run_id)
     run_id, raw_run_df = test_class.prep_raw_run_data()
+    add_feat_df = process_raw_run(raw_run_df)
+
+    # 1) Find run date/time; 2) remove time zone info
+    run_date = test_class.get_run_date(run_id)
+    return run_id, run_date, add_feat_df
+
+def process_raw_run(raw_run_df):
+    '''
+    Runs the Strava_single_run_data steps on a route stream
+    :return:
+        (dataframe): Strava data put in form to report data at 5s intervals
+    '''
     process_data = Strava_single_run_data(raw_run_df)
     process_data.setup_input()
     process_data.combine_t_inc_raw()
     process_data.add_dist_alt_deltas()
+    return process_data.add_feat_df
 
-    # 1) Find run date/time; 2) remove time zone info
-    run_date = test_class.activity_list[test_class.activity_list['id'] == run_id]['start_date']
-    return run_id, run_date, process_data.add_feat_df
+def process_run_frame(chosen_run_id, archive=None):
+    '''
+    Same as process_data, but returns the processed run as a RunFrame (built from the stream arrays
+    by process_streams, with no intermediate dataframes)
+    :param archive:
+        (RunArchive): if the run is archived it is read from there instead of Strava
+    :return:
+        (RunFrame): 5s interval data with run_id and start date attached
+    '''
+    if archive is not None and chosen_run_id is not None and chosen_run_id in archive:
+        return archive.get_run(chosen_run_id)
+    test_class = fbp_data_prep(client_id, client_secret, refresh_token, chosen_run_id)
+    run_id, raw_run_df = test_class.prep_raw_run_data()
+    return process_streams(raw_run_df, run_id=run_id, run_date=test_class.get_run_date(run_id))
+
+def update_run_archive(archive=None, chosen_run_ids=None, replace=False, stream_cache=None):
+    '''
+    Processes runs that are not in the archive yet and appends them. Existing runs are not rewritten.
+    :param archive:
+        (RunArchive): defaults to RunArchive() at ../run_archive
+    :param chosen_run_ids:
+        (list): Strava run ids; if none provided, all runs in the activity list. Ids that are not
+        runs are skipped
+    :param replace:
+        (bool): re-process chosen runs that are already archived (e.g., activity updated on Strava)
+    :param stream_cache:
+        (StreamCache): optional; cached streams are dropped for re-processed runs
+    :return:
+        (RunArchive): updated archive
+    '''
+    if archive is None:
+        archive = RunArchive()
+    strava = fbp_data_prep(client_id, client_secret, refresh_token, None, stream_cache)
+    run_ids = strava.run_list if chosen_run_ids is None else [x for x in chosen_run_ids if x in strava.run_list]
+    for run_id in tqdm([x for x in run_ids if replace or x not in archive]):
+        if replace and stream_cache is not None:
+            stream_cache.invalidate(run_id)
+        try:
+            run_frame = process_activity(strava, run_id, strava.get_run_date(run_id))
+        except Exception:
+            strava.error_log.append(run_id)
+        else:
+            archive.append(run_frame)
+            # stay under Strava rate limits
+            time.sleep(10)
+    return archive
 
 if __name__ == '__main__':
     print(process_data()[0])
\ No newline at end of file
@@ -1,5 +1,11 @@
+import numpy as np
 import pandas as pd
 
+from run_frame import RunFrame, to_naive_datetime64
+
+# Strava stream keys used by setup_input; request only these in get_route_stream
+STREAM_KEYS = ['time', 'distance', 'altitude', 'heartrate', 'cadence', 'temp']
+
 class Strava_single_run_data(object):
 
     def __init__(self, raw_strava_df):
@@ -39,13 +45,9 @@ class Strava_single_run_data(object):
         '''
         features = ['temp', 'time','cadence', 'distance', 'altitude',
                     'heartrate', 'pace']
-        self.EDA_df = self.raw_strava_df.copy()
-        if not self.EDA_df['latlng'].apply(lambda x: type(x) == list).any():
-        # latlng data imported as string vs. list in some instances
-            self.EDA_df['latlng'] = self.EDA_df['latlng'].str.strip('[]').str.split(',')
-            self.EDA_df['latlng'] = self.EDA_df['latlng'].apply(lambda x: [float(item) for item in x])
-
-        self.EDA_df['prev_latlng'] = self.shift_latlng(self.EDA_df)
+        # latlng is not an output feature; copy only the numeric streams rather than the
+        # object-dtype latlng lists
+        self.EDA_df = self.raw_strava_df[features[:-1]].copy()
         self.EDA_df['pace'] = self.EDA_df['distance'] / self.EDA_df['time']
         self.EDA_df['pace'].fillna(0, inplace=True)
         self.EDA_df = self.EDA_df[features][1:]
@@ -120,4 +122,63 @@ class Strava_single_run_data(object):
         self.add_feat_df['prev_dist'] = self.shift_dist(self.add_feat_df)
         self.add_feat_df['dist_delta'] = self.add_feat_df.apply(self.calc_dist_delta, axis=1)
         self.add_feat_df['alt_forecast'] = self.alt_delta_forecast(self.add_feat_df['alt_delta'])
-        return self.add_feat_df
\ No newline at end of file
+        return self.add_feat_df
+
+
+def process_streams(streams, run_id=None, run_date=None, inc=5):
+    '''
+    Same steps as Strava_single_run_data (setup_input, combine_t_inc_raw, add_dist_alt_deltas) on
+    NumPy arrays, filling a preallocated RunFrame without intermediate dataframes. Ties between
+    equally near recordings go to the earlier one (the pandas version's order is arbitrary)
+    :param streams:
+        (dict or dataframe): stream key -> values for STREAM_KEYS (e.g., get_route_stream output)
+    :return:
+        (RunFrame): 5s interval data
+    '''
+    # output skips time 0 due to irregularities (see setup_input)
+    raw = {key: np.asarray(streams[key], dtype=np.float64)[1:] for key in STREAM_KEYS}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw['pace'] = np.nan_to_num(raw['distance'] / raw['time'], nan=0., posinf=np.inf, neginf=-np.inf)
+    times = raw.pop('time')
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    raw = {key: values[order] for key, values in raw.items()}
+    intervals = np.arange(1, int(times[-1]) // inc + 1) * inc
+    frame = RunFrame(len(intervals), run_id=run_id, start_date=to_naive_datetime64(run_date))
+    frame.time[:] = intervals
+
+    # recording at each 5s interval, if any
+    right = np.searchsorted(times, intervals)
+    matched = (right < len(times)) & (times[np.minimum(right, len(times) - 1)] == intervals)
+    values = {key: np.where(matched, col[np.minimum(right, len(times) - 1)], np.nan) for key, col in raw.items()}
+    # intervals with no recording or a missing value: mean of the two nearest recordings, with
+    # distance prorated from the second nearest (combine_t_inc_raw)
+    missing = np.flatnonzero(~matched | np.isnan(np.column_stack(list(values.values()))).any(axis=1))
+    if missing.size:
+        x = intervals[missing].astype(np.float64)
+        # the two nearest recordings are among the two before and the two from each interval on
+        candidates = right[missing, None] + np.arange(-2, 2)
+        in_range = (candidates >= 0) & (candidates < len(times))
+        candidates = np.clip(candidates, 0, len(times) - 1)
+        gaps = np.where(in_range, np.abs(times[candidates] - x[:, None]), np.inf)
+        nearest = np.take_along_axis(candidates, np.argsort(gaps, axis=1, kind='stable')[:, :2], axis=1)
+        for key in ('temp', 'cadence', 'heartrate', 'pace', 'altitude'):
+            pair = raw[key][nearest]
+            # mean of the non-NaN values, as pandas does
+            with np.errstate(invalid='ignore'):
+                values[key][missing] = np.nansum(pair, axis=1) / (~np.isnan(pair)).sum(axis=1)
+        values['distance'][missing] = raw['distance'][nearest[:, 1]] * x / times[nearest[:, 1]]
+    for key, col in values.items():
+        getattr(frame, key)[:] = col
+
+    # deltas from the previous interval (add_dist_alt_deltas); the first altitude delta is 0
+    altitude = values['altitude']
+    prev_alt = np.r_[np.nan, altitude[:-1]]
+    alt_delta = altitude - np.where(np.isnan(prev_alt), altitude, prev_alt)
+    frame.alt_delta[:] = alt_delta
+    prev_dist = np.r_[0., values['distance'][:-1]]
+    frame.dist_delta[:] = values['distance'] - np.nan_to_num(prev_dist)
+    # net altitude change over the next 6 intervals (alt_delta_forecast); NaN counts as 0
+    cumsum = np.r_[0., np.cumsum(np.nan_to_num(alt_delta))]
+    frame.alt_forecast[:] = cumsum[np.minimum(np.arange(len(alt_delta)) + 6, len(alt_delta))] - cumsum[:-1]
+    return frame
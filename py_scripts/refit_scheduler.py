@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+from athlete_tables import grade
+from fbp_model import walk_forward_forecast
+from forecast_config import DEFAULT_CONFIG
+from run_archive import RunArchive
+
+''' Drift-triggered refitting for the walk-forward forecaster
+
+Instead of refitting every update, RefitScheduler refits only when:
+    * the current model's errors drift: two-sided CUSUM on residuals standardized by the model's
+      fitted observation noise (alarm when the cumulative excess over k sigma passes h)
+    * the upcoming grade (alt_forecast over distance) differs from the grade at the last fit
+    * the model is max_staleness periods old
+Between refits the current model forecasts each update with the latest regressors.
+
+e.g.:
+    result_df = walk_forward_forecast(run_frame, 'pace', scheduler=RefitScheduler())
+    report_df = compare_refit_policies(RunArchive(), target='pace')
+'''
+
+
+class RefitScheduler(object):
+    '''
+    Functions include:
+        * start(run_frame, config): reset for a new run
+        * fitted(stop, sigma): record a refit
+        * should_refit(stop, residuals): True if drift was detected or the model is too old
+    '''
+    def __init__(self, k=.5, h=5., grade_threshold=.03, max_staleness=24):
+        '''
+        :param k:
+            (float): CUSUM slack in sigmas; errors smaller than k sigma do not accumulate
+        :param h:
+            (float): CUSUM alarm threshold in sigmas
+        :param grade_threshold:
+            (float): change in upcoming grade (rise/run) that triggers a refit
+        :param max_staleness:
+            (int): 5s periods after which the model is refit regardless (24 = 2 min)
+        '''
+        self.k = k
+        self.h = h
+        self.grade_threshold = grade_threshold
+        self.max_staleness = max_staleness
+        self.reasons = []
+
+    def start(self, run_frame, config=DEFAULT_CONFIG):
+        self.grade = grade(run_frame)
+        self.window = config.horizons[config.primary_horizon]
+        self.reasons = []
+        self.fitted(None, np.nan)
+
+    def upcoming_grade(self, stop):
+        upcoming = self.grade[stop:stop + self.window]
+        return np.nanmean(upcoming) if np.isfinite(upcoming).any() else np.nan
+
+    def fitted(self, stop, sigma):
+        self.fit_stop = stop
+        # a perfect in-sample fit would make every residual an alarm
+        self.sigma = sigma if sigma > 0 else np.nan
+        self.fit_grade = np.nan if stop is None else self.upcoming_grade(stop)
+        self.cusum_pos = 0.
+        self.cusum_neg = 0.
+
+    def should_refit(self, stop, residuals):
+        '''
+        :param residuals:
+            (array): observed - forecast for the rows since the previous update
+        '''
+        reason = None
+        for z in np.asarray(residuals, dtype=np.float64) / self.sigma:
+            if np.isnan(z):
+                continue
+            self.cusum_pos = max(0., self.cusum_pos + z - self.k)
+            self.cusum_neg = max(0., self.cusum_neg - z - self.k)
+        if max(self.cusum_pos, self.cusum_neg) > self.h:
+            reason = 'residual_drift'
+        elif abs(self.upcoming_grade(stop) - self.fit_grade) > self.grade_threshold:
+            reason = 'grade_change'
+        elif self.fit_stop is None or stop - self.fit_stop >= self.max_staleness:
+            reason = 'max_staleness'
+        if reason is not None:
+            self.reasons.append((stop, reason))
+        return reason is not None
+
+
+def compare_refit_policies(archive=None, run_ids=None, target='pace', config=DEFAULT_CONFIG,
+                           scheduler_kwargs=None, uncertainty='off'):
+    '''
+    Backtests fixed-cadence and drift-triggered refitting on recorded runs
+    :param archive:
+        (RunArchive): defaults to RunArchive() at ../run_archive
+    :param run_ids:
+        (list): runs to compare; if none provided, every archived run
+    :param scheduler_kwargs:
+        (dict): RefitScheduler arguments
+    :return:
+        (dataframe): per run (plus an 'all' row): fits for each policy, fit reduction (%), and MAE
+        per horizon for each policy with the change (%)
+    '''
+    if archive is None:
+        archive = RunArchive()
+    run_ids = archive.run_ids if run_ids is None else run_ids
+    rows = []
+    errors = {'fixed': [], 'drift': []}
+    for run_id in run_ids:
+        run_frame = archive.get_run(run_id)
+        results = {
+            'fixed': walk_forward_forecast(run_frame, target, config, uncertainty, progress=False),
+            'drift': walk_forward_forecast(run_frame, target, config, uncertainty, progress=False,
+                                           scheduler=RefitScheduler(**(scheduler_kwargs or {}))),
+        }
+        if results['fixed'].empty:
+            continue
+        row = {'run_id': run_id}
+        for policy, result_df in results.items():
+            row[f'fits_{policy}'] = int(result_df['refit'].sum())
+            err_df = pd.DataFrame({h: result_df[f'yhat_{h}'] - result_df[f'y_{h}'] for h in config.horizons})
+            errors[policy].append(err_df)
+            for h in config.horizons:
+                row[f'mae_{h}_{policy}'] = err_df[h].abs().mean()
+        rows.append(row)
+    report_df = pd.DataFrame(rows)
+    if report_df.empty:
+        return report_df
+    total = {'run_id': 'all'}
+    for policy, err_dfs in errors.items():
+        total[f'fits_{policy}'] = report_df[f'fits_{policy}'].sum()
+        all_err = pd.concat(err_dfs, ignore_index=True)
+        for h in config.horizons:
+            total[f'mae_{h}_{policy}'] = all_err[h].abs().mean()
+    report_df = pd.concat([report_df, pd.DataFrame([total])], ignore_index=True)
+    report_df['fit_reduction'] = (1 - report_df['fits_drift'] / report_df['fits_fixed']) * 100
+    for h in config.horizons:
+        report_df[f'mae_{h}_change'] = (report_df[f'mae_{h}_drift'] / report_df[f'mae_{h}_fixed'] - 1) * 100
+    return report_df
+
+
+if __name__ == '__main__':
+    report_df = compare_refit_policies(target=input('Enter target (pace/cadence):'))
+    print(report_df.to_string())
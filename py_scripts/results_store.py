@@ -0,0 +1,177 @@
+import glob
+import os
+import socket
+import time
+import numpy as np
+import pandas as pd
+
+'''
+Append-only store for walk-forward forecast results.
+
+Results are partitioned by directory:
+    <path>/model_version=<v>/target=<t>/athlete=<a>/part-<run_id>-<pid>-<time_ns>.npz
+Each part file holds a batch of forecast updates as columns (ds, yhat_<horizon>, y_<horizon>, ...).
+Part files are never modified once written, so an interrupted backtest keeps every flushed batch.
+Parts written with a part_id (part-<part_id>.npz, e.g., one per run or job queue task) are replaced
+whole when the same part is written again. A run forecast more than once in a partition (e.g., by a
+script and by the job queue) is counted once: query keeps the newest row per (run_id, ds).
+'''
+
+PARTITION_KEYS = ('model_version', 'target', 'athlete')
+DEFAULT_ATHLETE = 'default'
+
+
+def write_part(part_dir, batch_df, name):
+    columns = {col: batch_df[col].to_numpy() for col in batch_df.columns}
+    if 'ds' in columns:
+        columns['ds'] = batch_df['ds'].to_numpy(dtype='datetime64[ns]')
+    # write under a temp name then rename so readers never load a partial part; the host is part of
+    # the name since workers on several machines may write the same task part
+    tmp_path = os.path.join(part_dir, f'.{name}.{socket.gethostname()}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(tmp_path, os.path.join(part_dir, name))
+
+
+class ResultsStore(object):
+    '''
+    Functions include:
+        * writer(model_version, target, athlete, run_id): incremental writer for one run
+        * query(**filters): dataframe of results for matching partitions
+        * error_metrics(by, **filters): MAE/RMSE/MAPE/bias per horizon
+    '''
+    def __init__(self, path='../results_store'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def partition_path(self, model_version, target, athlete=DEFAULT_ATHLETE):
+        values = dict(zip(PARTITION_KEYS, (model_version, target, athlete)))
+        for key, value in values.items():
+            if os.sep in str(value):
+                raise Exception(f'{key} cannot contain {os.sep}')
+        return os.path.join(self.path, *[f'{k}={v}' for k, v in values.items()])
+
+    def writer(self, model_version, target, athlete=DEFAULT_ATHLETE, run_id=None, flush_every=10):
+        return ResultsWriter(self.partition_path(model_version, target, athlete), run_id, flush_every)
+
+    def write(self, result_df, model_version, target, athlete=DEFAULT_ATHLETE, run_id=None, part_id=None):
+        '''
+        Writes a complete results dataframe as a single part
+        :param part_id:
+            (str): names the part part-<part_id>.npz, so writing the same part again (e.g., a rerun
+            task) replaces it instead of duplicating its rows; None writes a new part
+        '''
+        if result_df.empty:
+            return
+        part_dir = self.partition_path(model_version, target, athlete)
+        os.makedirs(part_dir, exist_ok=True)
+        result_df = result_df.copy()
+        if run_id is not None:
+            result_df['run_id'] = run_id
+        name = f'part-{run_id}-{os.getpid()}-{time.time_ns()}.npz' if part_id is None else f'part-{part_id}.npz'
+        write_part(part_dir, result_df, name)
+
+    def partitions(self, **filters):
+        '''
+        :param filters:
+            partition key=value (e.g., target='pace'); missing keys match everything
+        :return:
+            (list): (partition dict, directory) tuples
+        '''
+        for key in filters:
+            if key not in PARTITION_KEYS:
+                raise Exception(f'Can only filter on {PARTITION_KEYS}')
+        pattern = os.path.join(self.path, *[f'{k}={filters.get(k, "*")}' for k in PARTITION_KEYS])
+        output = []
+        for part_dir in sorted(glob.glob(pattern)):
+            rel_parts = os.path.relpath(part_dir, self.path).split(os.sep)
+            output.append((dict(item.split('=', 1) for item in rel_parts), part_dir))
+        return output
+
+    def query(self, **filters):
+        '''
+        :return:
+            (dataframe): every stored update for matching partitions plus partition columns; if a run
+            was written more than once, only the newest row per (run_id, ds) is kept
+        '''
+        frames = []
+        for partition, part_dir in self.partitions(**filters):
+            # oldest first so the newest copy of a duplicated update wins
+            for part_file in sorted(glob.glob(os.path.join(part_dir, 'part-*.npz')), key=os.path.getmtime):
+                with np.load(part_file) as data:
+                    part_df = pd.DataFrame({col: data[col] for col in data.files})
+                for key, value in partition.items():
+                    part_df[key] = value
+                frames.append(part_df)
+        if not frames:
+            return pd.DataFrame(columns=list(PARTITION_KEYS))
+        results_df = pd.concat(frames, ignore_index=True)
+        if {'run_id', 'ds'} <= set(results_df.columns):
+            duplicated = results_df.duplicated(list(PARTITION_KEYS) + ['run_id', 'ds'], keep='last')
+            results_df = results_df[~(duplicated & results_df['run_id'].notna())].reset_index(drop=True)
+        return results_df
+
+    def error_metrics(self, by=('model_version', 'target'), **filters):
+        '''
+        Aggregate forecast error for every horizon with both yhat_<horizon> and y_<horizon> columns
+        :param by:
+            (tuple): columns to group on (partition keys and/or run_id)
+        :return:
+            (dataframe): by columns + horizon, n, mae, rmse, mape (%), bias
+        '''
+        results_df = self.query(**filters)
+        horizons = [col[len('yhat_'):] for col in results_df.columns
+                    if col.startswith('yhat_') and f'y_{col[len("yhat_"):]}' in results_df.columns]
+        rows = []
+        for keys, group in results_df.groupby(list(by)):
+            keys = keys if isinstance(keys, tuple) else (keys,)
+            for horizon in horizons:
+                err = (group[f'yhat_{horizon}'] - group[f'y_{horizon}']).dropna()
+                actual = group.loc[err.index, f'y_{horizon}']
+                row = dict(zip(by, keys))
+                row.update({
+                    'horizon': horizon,
+                    'n': err.shape[0],
+                    'mae': err.abs().mean(),
+                    'rmse': np.sqrt((err ** 2).mean()),
+                    'mape': (err.abs() / actual.abs().replace(0, np.nan)).mean() * 100,
+                    'bias': err.mean(),
+                })
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+
+class ResultsWriter(object):
+    '''
+    Buffers forecast updates for one run and flushes them to a new part file every flush_every updates
+    (and on close)
+    '''
+    def __init__(self, part_dir, run_id=None, flush_every=10):
+        self.part_dir = part_dir
+        self.run_id = run_id
+        self.flush_every = flush_every
+        self.buffer = []
+        os.makedirs(part_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def add(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch_df = pd.DataFrame(self.buffer)
+        if self.run_id is not None:
+            batch_df['run_id'] = self.run_id
+        write_part(self.part_dir, batch_df, f'part-{self.run_id}-{os.getpid()}-{time.time_ns()}.npz')
+        self.buffer = []
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,148 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+
+from run_frame import RunFrame, COLUMNS, TIME_COLUMN, to_naive_datetime64
+
+'''
+On-disk archive of preprocessed runs (5s intervals).
+
+Layout of the archive directory:
+    * <column>.bin: one flat binary file per RunFrame column, all runs back to back
+    * index.json: activity id -> [start row, stop row, start date]
+
+Columns are read through read-only memory maps, so slicing a run is O(1), nothing is loaded until
+it is touched, and worker processes reading the same archive share the OS page cache. Appending
+a run only appends to the column files and rewrites the (small) index.
+
+Several processes may append (e.g., update_run_archive and the webhook daemon): each append holds
+an exclusive lock on <path>/.lock and re-reads the index and column file lengths under it.
+'''
+
+COLUMN_DTYPES = {col: np.float32 for col in COLUMNS}
+COLUMN_DTYPES[TIME_COLUMN] = np.int32
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+
+class RunArchive(object):
+    '''
+    Functions include:
+        * append(run_frame): add a preprocessed run (re-appending an id replaces it in the index)
+        * get_run(run_id): RunFrame whose columns are memory-mapped views
+        * get_runs(run_ids): list of RunFrames for a set of runs
+    '''
+    def __init__(self, path='../run_archive'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = self.load_index()
+        self.n_rows = max([loc[1] for loc in self.index.values()], default=0)
+        self._maps = {}
+
+    def load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            return {int(k): v for k, v in json.load(f).items()}
+
+    def save_index(self):
+        # write then rename so readers never see a partial index
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({str(k): v for k, v in self.index.items()}, f)
+        os.replace(tmp_path, index_path)
+
+    def refresh(self):
+        '''
+        Reloads the index (e.g., after another process appended runs)
+        '''
+        self.index = self.load_index()
+        self.n_rows = max([loc[1] for loc in self.index.values()], default=0)
+
+    def __contains__(self, run_id):
+        return int(run_id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def run_ids(self):
+        return list(self.index)
+
+    def column_path(self, col):
+        return os.path.join(self.path, f'{col}.bin')
+
+    def column_rows(self, col):
+        '''
+        Rows in a column file, rounded up so a partial row is never overwritten
+        '''
+        if not os.path.exists(self.column_path(col)):
+            return 0
+        return -(-os.path.getsize(self.column_path(col)) // np.dtype(COLUMN_DTYPES[col]).itemsize)
+
+    @contextmanager
+    def lock(self):
+        '''
+        Exclusive lock shared by every process appending to this archive
+        '''
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, run_frame):
+        '''
+        Appends a run to the end of every column file
+        :param run_frame:
+            (RunFrame): processed run with run_id set
+        :return:
+            None
+        '''
+        if run_frame.run_id is None:
+            raise Exception('run_frame.run_id must be set to archive a run')
+        with self.lock():
+            # other processes may have appended since this instance loaded the index
+            self.refresh()
+            # rows left by an interrupted append are skipped, never truncated
+            start = max([self.n_rows] + [self.column_rows(col) for col in COLUMNS])
+            for col in COLUMNS:
+                data = np.ascontiguousarray(getattr(run_frame, col), dtype=COLUMN_DTYPES[col])
+                with open(self.column_path(col), 'ab') as f:
+                    f.write(bytes(start * data.itemsize - f.tell()))
+                    f.write(data.tobytes())
+            start_date = None if run_frame.start_date is None else str(run_frame.start_date)
+            self.index[int(run_frame.run_id)] = [start, start + len(run_frame), start_date]
+            self.n_rows = start + len(run_frame)
+            self.save_index()
+
+    def column_map(self, col):
+        '''
+        Read-only memory map of a column file; remapped when the file has grown since last mapped
+        '''
+        col_map = self._maps.get(col)
+        if col_map is None or col_map.shape[0] < self.n_rows:
+            col_map = np.memmap(self.column_path(col), dtype=COLUMN_DTYPES[col], mode='r',
+                                shape=(self.n_rows,))
+            self._maps[col] = col_map
+        return col_map
+
+    def get_run(self, run_id):
+        '''
+        :return:
+            (RunFrame): columns are views into the memory-mapped archive (no copy)
+        '''
+        start, stop, start_date = self.index[int(run_id)]
+        columns = {col: self.column_map(col)[start:stop] for col in COLUMNS}
+        return RunFrame.from_arrays(columns, run_id=int(run_id),
+                                    start_date=to_naive_datetime64(start_date))
+
+    def get_runs(self, run_ids=None):
+        if run_ids is None:
+            run_ids = self.run_ids
+        return [self.get_run(run_id) for run_id in run_ids]
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+'''
+Compact array-backed representation of a processed run (5s intervals).
+
+Each feature is held in its own preallocated, contiguous NumPy column so training windows and
+future regressors can be sliced as views. Pandas dataframes are only built at library boundaries
+(e.g., Facebook Prophet fit/predict).
+'''
+
+# time is stored as whole seconds; every other feature is float32
+TIME_COLUMN = 'time'
+FLOAT_COLUMNS = ('temp', 'distance', 'altitude', 'alt_delta', 'alt_forecast',
+                 'pace', 'cadence', 'heartrate', 'dist_delta')
+COLUMNS = (TIME_COLUMN,) + FLOAT_COLUMNS
+
+
+class RunFrame(object):
+    '''
+    Fixed-size columnar container for a single processed run. Functions include:
+        * from_dataframe(df): build from Strava_single_run_data output
+        * window(start, stop): zero-copy view of a range of 5s intervals
+        * to_fbp_df(target, regressors): dataframe in Facebook Prophet format
+    '''
+    __slots__ = ('run_id', 'start_date', 'n_rows') + COLUMNS
+
+    def __init__(self, n_rows, run_id=None, start_date=None):
+        self.run_id = run_id
+        self.start_date = start_date
+        self.n_rows = n_rows
+        self.time = np.zeros(n_rows, dtype=np.int32)
+        for col in FLOAT_COLUMNS:
+            setattr(self, col, np.full(n_rows, np.nan, dtype=np.float32))
+
+    @classmethod
+    def from_arrays(cls, columns, run_id=None, start_date=None):
+        '''
+        Wraps existing arrays without copying them (e.g., slices of a larger array)
+        :param columns:
+            (dict): column name to 1d array; all arrays must share the same length
+        :return:
+            RunFrame
+        '''
+        frame = cls.__new__(cls)
+        frame.run_id = run_id
+        frame.start_date = start_date
+        frame.n_rows = len(columns[TIME_COLUMN])
+        for col in COLUMNS:
+            if col in columns:
+                setattr(frame, col, columns[col])
+            else:
+                setattr(frame, col, np.full(frame.n_rows, np.nan, dtype=np.float32))
+        return frame
+
+    @classmethod
+    def from_dataframe(cls, df, run_id=None, run_date=None):
+        '''
+        Copies the processed run dataframe into typed columns. Columns not listed in COLUMNS
+        (e.g., prev_alt, prev_dist) are dropped.
+        :param df:
+            (dataframe): output of Strava_single_run_data.add_dist_alt_deltas()
+        :param run_date:
+            (series or timestamp): activity start date
+        :return:
+            RunFrame
+        '''
+        frame = cls(df.shape[0], run_id=run_id, start_date=to_naive_datetime64(run_date))
+        time_col = '5s_intervals' if '5s_intervals' in df.columns else TIME_COLUMN
+        frame.time[:] = df[time_col].to_numpy()
+        for col in FLOAT_COLUMNS:
+            if col in df.columns:
+                getattr(frame, col)[:] = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+        return frame
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, col).nbytes for col in COLUMNS)
+
+    def column(self, name, start=0, stop=None):
+        return getattr(self, name)[start:stop]
+
+    def window(self, start=0, stop=None):
+        '''
+        Returns a RunFrame whose columns are views into this frame; no data is copied
+        '''
+        columns = {col: getattr(self, col)[start:stop] for col in COLUMNS}
+        return RunFrame.from_arrays(columns, run_id=self.run_id, start_date=self.start_date)
+
+    def ds(self, start=0, stop=None):
+        '''
+        Timestamps for each 5s interval (Facebook Prophet requires datetime64 with no time zone)
+        '''
+        offsets = self.time[start:stop].astype('timedelta64[s]')
+        if self.start_date is None:
+            return offsets
+        return self.start_date + offsets
+
+    def to_fbp_df(self, target, regressors, start=0, stop=None):
+        '''
+        Builds a dataframe for Facebook Prophet
+        :param target:
+            (str): column used as y (e.g., 'pace' or 'cadence'); None for prediction frames
+        :param regressors:
+            (list): exogenous columns to include
+        :return:
+            (dataframe): ds, y plus regressor columns
+        '''
+        data = {'ds': self.ds(start, stop)}
+        if target is not None:
+            data['y'] = getattr(self, target)[start:stop]
+        for col in regressors:
+            data[col] = getattr(self, col)[start:stop]
+        return pd.DataFrame(data)
+
+    def to_dataframe(self):
+        data = {'5s_intervals': self.time}
+        for col in FLOAT_COLUMNS:
+            data[col] = getattr(self, col)
+        return pd.DataFrame(data)
+
+
+def to_naive_datetime64(run_date):
+    '''
+    Converts the activity start date (series from activity_list or a timestamp) to a
+    timezone-naive datetime64
+    '''
+    if run_date is None:
+        return None
+    if isinstance(run_date, pd.Series):
+        run_date = run_date.iloc[0]
+    run_date = pd.Timestamp(run_date)
+    if run_date.tzinfo is not None:
+        run_date = run_date.tz_convert(None)
+    return run_date.to_datetime64()
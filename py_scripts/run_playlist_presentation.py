@@ -3,13 +3,19 @@ import random
 import time
 
 from spotify_client_PC import *
+from playlist_pool import PlaylistPoolBuilder
 from process_prophet_output_pace import analyze_run_for_music
 import spotify_cfg
+from forecast_config import DEFAULT_CONFIG
+from session_checkpoint import SessionCheckpoint
 
 '''
 This script was created for demo purposes only. I used it as a tool for presenting my final project at Metis
 '''
 
+# a checkpoint older than this is from an abandoned session, not a crash of the current one
+MAX_RESUME_AGE = 3 * 3600
+
 
 def select_playlist(query='EDM 150 bpm'):
     '''
@@ -92,6 +98,7 @@ def initiate_playback(total_df):
     :return:
         music_len (int): duartion of song in milliseconds
         init_state (string): initial speed of song selected (slower/none/faster)
+        init_song_uri (string): uri of the song started
     '''
     init_state = total_df.loc[0, 'sng_speed_change']
     init_song_idx = next_track_idx(edm_af, init_state)
@@ -99,23 +106,74 @@ def initiate_playback(total_df):
     music_len = edm_af.loc[init_song_idx, 'duration_ms']
     print(f"tempo:{edm_af.loc[init_song_idx, 'tempo']}")
     spc.play(qtype='track', uri=init_song_uri)
-    return music_len, init_state
+    return music_len, init_state, edm_af.loc[init_song_idx, 'uri']
+
+def restore_playback(song_queue, elapsed):
+    '''
+    Restarts the song that was playing at elapsed seconds and queues the songs after it
+    :param song_queue:
+        (list): checkpointed {'uri', 'start'} entries in the order they were queued
+    :param elapsed:
+        (float): run seconds at the resumed interval
+    '''
+    started = [song for song in song_queue if song['start'] <= elapsed]
+    upcoming = [song for song in song_queue if song['start'] > elapsed]
+    if started:
+        spc.play(qtype='track', uri=started[-1]['uri'].split(':')[2])
+    for song in upcoming:
+        spc.add_song_queue(song['uri'])
+
+def load_session(checkpoint, run_id):
+    '''
+    :return:
+        (dict): checkpointed state to resume; None to start the run over
+    '''
+    state = checkpoint.load_state()
+    if state is None:
+        return None
+    age = time.time() - state['saved_at']
+    if state['run_id'] != run_id:
+        print(f"Checkpoint is for run {state['run_id']}, not run {run_id}")
+        return None
+    if age > MAX_RESUME_AGE and input(f'Checkpoint is {age / 3600:.1f} hours old; resume anyway? (y/n):') != 'y':
+        return None
+    return state
 
 if __name__ == '__main__':
 
     spc = SpotifyAPI(spotify_cfg.client_id, spotify_cfg.client_secret)
-
-    # Get audio features from playlist songs
-    selected_pl = select_playlist(query='EDM 150 bpm')
-    uri_list = get_playlist_uris(selected_pl)
-    edm_af = spc.get_audio_features(uri_list)
-    edm_proc_af = process_audio_features(edm_af)
-    total_df, run_id = analyze_run_for_music()
-    start_time=int(input('Enter Time Interval:'))
-    # initiate playback and keep track of music length
-    # Note adjustment to music length for presentation due to changing starting point
-    global_music_len, current_state = initiate_playback(total_df)
-    global_music_len += 180+start_time*30
+    run_id = int(input('Enter run id:'))
+    # playback state is checkpointed every interval per run; a crashed session resumes where it stopped
+    checkpoint = SessionCheckpoint(session_id=f'presentation_{run_id}')
+    state = load_session(checkpoint, run_id)
+    if state is not None:
+        edm_af = checkpoint.load_frame('pool')
+        total_df = checkpoint.load_frame('total')
+        start_time = state['times'] + 1
+        global_music_len, current_state = state['music_len'], state['current_state']
+        song_queue = state['queue']
+        print(f'Resuming run {run_id} at interval {start_time}')
+        if start_time < total_df.shape[0]:
+            restore_playback(song_queue, total_df.loc[start_time, 'ds'])
+    else:
+        checkpoint.clear()
+        checkpoint = SessionCheckpoint(session_id=f'presentation_{run_id}')
+        # Get audio features for the candidate pool (search results plus the original demo playlist)
+        pool_builder = PlaylistPoolBuilder(spc)
+        edm_af = pool_builder.build(queries=['EDM 150 bpm'], playlist_ids=['3YgpDQqiu3hSEyRczMvJ9F'])
+        edm_proc_af = process_audio_features(edm_af)
+        total_df, run_id = analyze_run_for_music(run_id)
+        checkpoint.save_frame('pool', edm_af)
+        checkpoint.save_frame('total', total_df)
+        start_time = 0
+        # initiate playback and keep track of music length
+        # music length is counted from the start of the run; the first forecast is after train_seconds
+        global_music_len, current_state, song_uri = initiate_playback(total_df)
+        global_music_len += DEFAULT_CONFIG.train_seconds
+        # every song sent to the player and the run second it starts, replayed by restore_playback
+        song_queue = [{'uri': song_uri, 'start': 0.}]
+        checkpoint.save_state({'run_id': int(run_id), 'times': -1, 'music_len': float(global_music_len),
+                               'current_state': str(current_state), 'queue': song_queue})
     for times in range(start_time, total_df.shape[0]):  # len 90
         print(times)
         proj_tempo = total_df.loc[times, 'sng_speed_change']
@@ -128,14 +186,19 @@ if __name__ == '__main__':
             print(f"tempo: {edm_af.loc[song_idx, 'tempo']}")
             spc.add_song_queue(song_uri)
             spc.next_song()
+            song_queue.append({'uri': song_uri, 'start': float(total_df.loc[times, 'ds'])})
         # song will end in next time interval; queue new
-        if (global_music_len - total_df.loc[times, 'ds']) < 30:
+        if (global_music_len - total_df.loc[times, 'ds']) < DEFAULT_CONFIG.update_seconds:
             choice = edm_af[edm_af['tempo_bin'] == current_state].index
             song_idx = next_track_idx(edm_af, current_state)
             song_uri = edm_af.loc[song_idx, 'uri']
             spc.add_song_queue(song_uri)
             print(edm_af.loc[song_idx, 'tempo'])
+            song_queue.append({'uri': song_uri, 'start': float(global_music_len)})
             global_music_len += edm_af.loc[song_idx, 'duration_ms']
             print(f'song time remaining from new add:{global_music_len}')
+        checkpoint.save_state({'run_id': int(run_id), 'times': times, 'music_len': float(global_music_len),
+                               'current_state': str(current_state), 'queue': song_queue})
         # Emulating time sleep 30 seconds
-        time.sleep(30)
+        time.sleep(DEFAULT_CONFIG.update_seconds)
+    checkpoint.clear()
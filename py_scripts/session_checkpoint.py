@@ -0,0 +1,138 @@
+import json
+import os
+import pickle
+import time
+import numpy as np
+
+from run_frame import COLUMNS
+
+''' Checkpoints for an in-progress run session, so a crashed playback script or forecaster resumes
+where it left off instead of refetching, reprocessing and refitting from the start
+
+Layout of <path>/<session_id>/ (one writer per file):
+    * samples.bin: processed 5s samples (float64 rows in RunFrame COLUMNS order), appended as they
+      arrive; a partially written last row is ignored on load
+    * model.json: latest fitted Prophet model (fbprophet.serialize) and the sample count it was fit on
+    * state.json: playback state (position, current tempo bin, queued tracks, ...)
+    * <name>.pkl: dataframes written once per session (e.g., the song pool)
+json files are written under a temp name and renamed, so a crash never leaves a partial checkpoint.
+
+e.g.:
+    checkpoint = SessionCheckpoint(session_id=run_id)
+    if checkpoint.exists():
+        state = checkpoint.load_state()
+'''
+
+ROW_BYTES = len(COLUMNS) * 8
+
+
+def write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class SessionCheckpoint(object):
+    '''
+    Functions include:
+        * append_sample(sample)/load_samples(): processed samples
+        * save_model(model, samples_seen)/load_model(): latest fitted model
+        * save_state(state)/load_state(): playback position and track queue
+        * save_frame(name, df)/load_frame(name): session dataframes
+        * clear(): delete the checkpoint once the session is finished
+    '''
+    def __init__(self, path='../session_checkpoints', session_id='default'):
+        self.root = path
+        self.session_id = session_id
+        self.path = os.path.join(path, str(session_id))
+        os.makedirs(self.path, exist_ok=True)
+        self.samples_file = None
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self.file_path('state.json')) or self.n_samples() > 0
+
+    def n_samples(self):
+        samples_path = self.file_path('samples.bin')
+        return os.path.getsize(samples_path) // ROW_BYTES if os.path.exists(samples_path) else 0
+
+    def append_sample(self, sample):
+        '''
+        :param sample:
+            (dict): column -> value; missing columns are NaN
+        '''
+        if self.samples_file is None:
+            samples_path = self.file_path('samples.bin')
+            # drop a partial row left by a crash before appending
+            if os.path.exists(samples_path):
+                os.truncate(samples_path, self.n_samples() * ROW_BYTES)
+            self.samples_file = open(samples_path, 'ab')
+        row = np.array([sample.get(col, np.nan) for col in COLUMNS], dtype=np.float64)
+        self.samples_file.write(row.tobytes())
+        self.samples_file.flush()
+
+    def load_samples(self):
+        '''
+        :return:
+            (array): n_samples x len(COLUMNS) float64
+        '''
+        n = self.n_samples()
+        if not n:
+            return np.empty((0, len(COLUMNS)))
+        return np.fromfile(self.file_path('samples.bin'), dtype=np.float64, count=n * len(COLUMNS)).reshape(n, -1)
+
+    def save_model(self, model, samples_seen):
+        from fbprophet.serialize import model_to_json
+        write_json(self.file_path('model.json'), {'samples_seen': samples_seen, 'saved_at': time.time(),
+                                                  'model': model_to_json(model)})
+
+    def load_model(self):
+        '''
+        :return:
+            model: fitted Prophet model; None if no model was saved
+            samples_seen (int): samples the model was fit on
+        '''
+        model_path = self.file_path('model.json')
+        if not os.path.exists(model_path):
+            return None, 0
+        from fbprophet.serialize import model_from_json
+        with open(model_path) as f:
+            checkpoint = json.load(f)
+        return model_from_json(checkpoint['model']), checkpoint['samples_seen']
+
+    def save_state(self, state):
+        write_json(self.file_path('state.json'), dict(state, saved_at=time.time()))
+
+    def load_state(self):
+        state_path = self.file_path('state.json')
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as f:
+            return json.load(f)
+
+    def save_frame(self, name, df):
+        tmp_path = self.file_path(f'{name}.pkl.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(df, f)
+        os.replace(tmp_path, self.file_path(f'{name}.pkl'))
+
+    def load_frame(self, name):
+        frame_path = self.file_path(f'{name}.pkl')
+        if not os.path.exists(frame_path):
+            return None
+        with open(frame_path, 'rb') as f:
+            return pickle.load(f)
+
+    def close(self):
+        if self.samples_file is not None:
+            self.samples_file.close()
+            self.samples_file = None
+
+    def clear(self):
+        self.close()
+        for name in os.listdir(self.path):
+            os.remove(self.file_path(name))
+        os.rmdir(self.path)
@@ -166,10 +166,8 @@ class SpotifyAPI(object):
         r = requests.get(endpoint + uri_cs, headers=headers)
         edm_af = r.json()
 
-        # Organize output into a pandas DF
-        af_df = pd.DataFrame()
-        for songs in edm_af['audio_features']:
-            af_df = af_df.append(songs, ignore_index=True)
+        # Organize output into a pandas DF (built once rather than appending row by row)
+        af_df = pd.DataFrame([songs for songs in edm_af['audio_features'] if songs])
         return af_df
 
     def add_song_queue(self, uri):
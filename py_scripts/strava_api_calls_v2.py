@@ -1,12 +1,17 @@
 import requests
+import numpy as np
 import pandas as pd
 import datetime
 import time
 import urllib3
 from tqdm import tqdm
 from strava_cfg import *
+from stream_decoder import decode_streams
 
 token_url = 'https://www.strava.com/api/v3/oauth/token'
+# every stream key requested by default; consumers should request only the keys they use
+ALL_STREAM_KEYS = ['time', 'distance', 'latlng', 'altitude', 'velocity_smooth', 'heartrate',
+                   'cadence', 'temp', 'grade_smooth']
 
 class StravaAPI(object):
     '''
@@ -15,13 +20,15 @@ class StravaAPI(object):
         * specific run data
     TODO: Create function to get access token for other users. Will entail creating a web module that gets the token after receiving approval from user
     '''
-    def __init__(self, client_id, client_secret, refresh_token, *args, **kwargs):
+    def __init__(self, client_id, client_secret, refresh_token, stream_cache=None, *args, **kwargs):
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
+        # optional StreamCache; if None every stream request goes to Strava
+        self.stream_cache = stream_cache
         self.access_token, self.token_expire_time = self.get_access_token()
         self.activity_list = self.get_activity_list()
-        self.error_log = None
+        self.error_log = []
 
     def get_access_token(self):
         payload = {
@@ -47,23 +54,24 @@ class StravaAPI(object):
             # extract access token from url;
         return access_token, token_expire_time
 
-    def get_response(self, url):
+    def get_raw_response(self, url, stream=False):
         if datetime.datetime.now() > self.token_expire_time:
-            self.get_access_token()
-        if self.access_token:
-            headers = {'Authorization': 'Bearer ' + self.access_token,
-                       "Accept": "application/json",
-                       "Content-Type": "application/json"
-                       }
-            response = requests.request(
-                "GET",
-                url,
-                headers=headers
-            )
-            data = response.json()
-        else:
-            print('Must get access token first')
-        return data
+            self.access_token, self.token_expire_time = self.get_access_token()
+        if not self.access_token:
+            raise Exception('Must get access token first')
+        headers = {'Authorization': 'Bearer ' + self.access_token,
+                   "Accept": "application/json",
+                   "Content-Type": "application/json"
+                   }
+        return requests.request(
+            "GET",
+            url,
+            headers=headers,
+            stream=stream
+        )
+
+    def get_response(self, url):
+        return self.get_raw_response(url).json()
 
     def process_activity_list(self, df):
         output_df = df.drop(['location_city', 'location_state', 'location_country'], axis=1).copy()
@@ -82,27 +90,77 @@ class StravaAPI(object):
         activity_list = list_df[list_df['type'].isin(activity)]
         return activity_list
 
+    def get_activity(self, activity_id):
+        '''
+        Details for a single activity (type, start_date, ...)
+        '''
+        url = f"https://www.strava.com/api/v3/activities/{activity_id}"
+        response = self.get_raw_response(url)
+        if response.status_code != 200:
+            raise Exception(f'Activity request failed ({response.status_code}): {url}')
+        return response.json()
+
     # THIS METHOD BROKE AT SOME POINT; PROBABLY NEED TO FIX ENDPOINT URL
     # def get_heart_zones(self):
     #     endpoint = "https://www.strava.com/api/v3/activities/3942323714/zones"
     #     hz_output = self.get_response(endpoint)
     #     return hz_output
 
-    def get_route_stream(self, run_id):
+    def get_route_stream(self, run_id, keys=ALL_STREAM_KEYS, resolution=None, series_type=None):
+        '''
+        Gets activity streams, served from the stream cache when a cached request covered the keys
+        :param keys:
+            (list): stream keys to request (see ALL_STREAM_KEYS)
+        :param resolution:
+            (str): 'low', 'medium' or 'high' to downsample; None for all data points
+        :param series_type:
+            (str): 'time' or 'distance'; what to downsample on (only used with resolution)
+        :return:
+            (dataframe): one column per requested key the activity has; latlng is returned as
+            lat and lng columns
+        '''
+        keys = list(keys)
+        if resolution is None:
+            series_type = None
+        streams = None
+        if self.stream_cache is not None:
+            streams = self.stream_cache.get(run_id, keys, resolution, series_type)
+        if streams is None:
+            url = "https://www.strava.com/api/v3/activities/" +str(run_id)+ "/streams?keys=" + ','.join(keys) + "&key_by_type=true"
+            if resolution:
+                url += f"&resolution={resolution}&series_type={series_type or 'distance'}"
+            streams = self.get_stream_arrays(url, keys)
+            if self.stream_cache is not None:
+                self.stream_cache.put(run_id, keys, streams, resolution, series_type)
         df = pd.DataFrame()
-        url = "https://www.strava.com/api/v3/activities/" +str(run_id)+ "/streams?keys=time,distance,latlng,altitude,velocity_smooth,heartrate,cadence,temp,grade_smooth&key_by_type=true"
-        rt_stream_output = self.get_response(url)
-        for k, v in rt_stream_output.items():
-            df[k] = v['data']
+        for k in keys:
+            if k == 'latlng' and k in streams:
+                # N x 2 array split into float columns rather than a list per row
+                latlng = np.asarray(streams[k], dtype=np.float64).reshape(-1, 2)
+                df['lat'] = latlng[:, 0]
+                df['lng'] = latlng[:, 1]
+            elif k in streams:
+                df[k] = streams[k]
         return df
 
+    def get_stream_arrays(self, url, keys):
+        '''
+        Downloads a streams payload and decodes it directly into NumPy arrays as it arrives
+        :return:
+            (dict): stream key -> array (latlng is N x 2 float64)
+        '''
+        response = self.get_raw_response(url, stream=True)
+        if response.status_code != 200:
+            raise Exception(f'Stream request failed ({response.status_code}): {url}')
+        return decode_streams(response.iter_content(chunk_size=64 * 1024), keys)
+
     def extract_run_data(self):
         '''
         Creates a dataframe that aggregates data for all runs
         :return:
             (dataframe): includes all features from get_route_stream function
         '''
-        df = pd.DataFrame()
+        run_dfs = []
         for acts in tqdm(self.activity_list['id']):
             try:
                 rt_df = self.get_route_stream(acts)
@@ -110,6 +168,9 @@ class StravaAPI(object):
                 self.error_log.append(acts)
             else:
                 rt_df.insert(0, 'activity_id', acts)
-                df = pd.concat([df, rt_df])
+                run_dfs.append(rt_df)
                 time.sleep(10)
-        return df
\ No newline at end of file
+        # single concat; concatenating inside the loop copies every prior run again
+        if not run_dfs:
+            return pd.DataFrame()
+        return pd.concat(run_dfs)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import json
+import queue
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from run_archive import RunArchive
+
+'''
+Receiver for Strava webhook events (https://developers.strava.com/docs/webhooks/).
+
+Strava validates a subscription with a GET (hub.mode, hub.verify_token, hub.challenge) and then
+POSTs one event per activity change. Events must be acknowledged within 2 seconds, so the receiver
+only queues activity ids; a background worker downloads, preprocesses and archives them.
+
+For local testing, run the receiver and use send_validation()/send_event() as a stand-in for Strava:
+    receiver = WebhookReceiver(verify_token='token', processor=print)
+    server = receiver.serve(port=8000, background=True)
+    send_validation('http://localhost:8000', 'token')
+    send_event('http://localhost:8000', 3247665259)
+'''
+
+QUEUED_ASPECTS = ('create', 'update')
+
+
+class ActivityArchiver(object):
+    '''
+    Default processor: download, preprocess and archive a new or updated run. One Strava client is
+    reused for every event; failures are raised so the receiver records them in its error_log
+    '''
+    def __init__(self, archive=None, stream_cache=None, tables=None):
+        '''
+        :param tables:
+            (AthleteTables): optional; runs are added to (or replaced in) the athlete's lookup tables
+        '''
+        self.archive = RunArchive() if archive is None else archive
+        self.stream_cache = stream_cache
+        self.tables = tables
+        self.client = None
+
+    def get_client(self):
+        # created on first event so the receiver can run without Strava credentials (e.g., local testing)
+        if self.client is None:
+            from strava_api_calls_v2 import StravaAPI
+            from strava_cfg import client_id, client_secret, refresh_token
+            self.client = StravaAPI(client_id, client_secret, refresh_token, self.stream_cache)
+        return self.client
+
+    def __call__(self, activity_id, aspect_type):
+        '''
+        :return:
+            (bool): True if the run was archived; False if the activity is not a run or is already archived
+        '''
+        from prep_data_FBP import process_activity
+        # other processes (e.g., update_run_archive or a backfill) may have written since the last event;
+        # append() re-reads the index again under the archive lock
+        self.archive.refresh()
+        if self.tables is not None:
+            self.tables.load()
+        client = self.get_client()
+        activity = client.get_activity(activity_id)
+        if activity.get('type') != 'Run':
+            return False
+        replace = aspect_type == 'update'
+        if activity_id in self.archive and not replace:
+            return False
+        if replace and self.stream_cache is not None:
+            self.stream_cache.invalidate(activity_id)
+        run_frame = process_activity(client, activity_id, activity['start_date'])
+        if self.tables is not None and activity_id in self.archive:
+            self.tables.remove(self.archive.get_run(activity_id))
+        self.archive.append(run_frame)
+        if self.tables is not None:
+            self.tables.update(self.archive, [activity_id])
+        return True
+
+
+class WebhookReceiver(object):
+    '''
+    Functions include:
+        * handle_validation(params): answer Strava's subscription validation request
+        * handle_event(event): queue created/updated activities
+        * serve(port): run the HTTP endpoint
+    '''
+    def __init__(self, verify_token, processor=None):
+        '''
+        :param processor:
+            (callable): called with (activity_id, aspect_type) on the worker thread; exceptions are
+            recorded in error_log. Defaults to ActivityArchiver()
+        '''
+        self.verify_token = verify_token
+        self.processor = ActivityArchiver() if processor is None else processor
+        self.event_queue = queue.Queue()
+        # activity ids queued but not processed yet; repeated events for the same id are merged
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.error_log = []
+        self.worker = threading.Thread(target=self.process_events, daemon=True)
+        self.worker.start()
+
+    def handle_validation(self, params):
+        '''
+        :param params:
+            (dict): query parameters of the GET request
+        :return:
+            (int, dict): HTTP status and JSON body
+        '''
+        if params.get('hub.mode') == 'subscribe' and params.get('hub.verify_token') == self.verify_token:
+            return 200, {'hub.challenge': params.get('hub.challenge')}
+        return 403, {}
+
+    def handle_event(self, event):
+        '''
+        :param event:
+            (dict): Strava event (object_type, object_id, aspect_type, owner_id, updates, ...)
+        :return:
+            (bool): True if the activity was queued
+        '''
+        if event.get('object_type') != 'activity' or event.get('aspect_type') not in QUEUED_ASPECTS:
+            return False
+        activity_id = int(event['object_id'])
+        with self.pending_lock:
+            if activity_id in self.pending:
+                return True
+            self.pending.add(activity_id)
+        self.event_queue.put((activity_id, event['aspect_type']))
+        return True
+
+    def process_events(self):
+        while True:
+            activity_id, aspect_type = self.event_queue.get()
+            with self.pending_lock:
+                self.pending.discard(activity_id)
+            try:
+                self.processor(activity_id, aspect_type)
+            except Exception as e:
+                self.error_log.append((activity_id, repr(e)))
+            finally:
+                self.event_queue.task_done()
+
+    def join(self):
+        '''
+        Blocks until every queued event has been processed
+        '''
+        self.event_queue.join()
+
+    def serve(self, host='', port=8000, background=False):
+        '''
+        Starts the HTTP endpoint. If background, runs in a daemon thread and returns the server
+        (call server.shutdown() to stop)
+        '''
+        server = ThreadingHTTPServer((host, port), make_handler(self))
+        if background:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        else:
+            server.serve_forever()
+        return server
+
+
+def make_handler(receiver):
+    '''
+    Creates a request handler class bound to a WebhookReceiver
+    '''
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            self.send_json(*receiver.handle_validation(params))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                event = json.loads(self.rfile.read(length))
+            except ValueError:
+                self.send_json(400, {})
+                return
+            # acknowledge right away; processing happens on the worker thread
+            self.send_json(200, {'queued': receiver.handle_event(event)})
+
+        def log_message(self, *args):
+            pass
+
+    return WebhookHandler
+
+
+def send_validation(url, verify_token, challenge='15f7d1a91c1f40f8a748fd134752feb3'):
+    '''
+    Local stand-in for Strava's subscription validation request
+    :return:
+        (dict): receiver response; should echo hub.challenge
+    '''
+    params = {'hub.mode': 'subscribe', 'hub.verify_token': verify_token, 'hub.challenge': challenge}
+    return requests.get(url, params=params).json()
+
+
+def send_event(url, activity_id, aspect_type='create', owner_id=0, updates=None):
+    '''
+    Local stand-in for a Strava activity event
+    :return:
+        (dict): receiver response
+    '''
+    event = {
+        'object_type': 'activity',
+        'object_id': activity_id,
+        'aspect_type': aspect_type,
+        'owner_id': owner_id,
+        'subscription_id': 0,
+        'event_time': 0,
+        'updates': updates or {},
+    }
+    return requests.post(url, json=event).json()
+
+
+if __name__ == '__main__':
+    from strava_cfg import *
+    # strava_cfg can define verify_token; it must match the one used to create the subscription
+    receiver = WebhookReceiver(verify_token=globals().get('verify_token', 'STRAVA'))
+    receiver.serve(port=8000)
@@ -0,0 +1,61 @@
+import os
+import pickle
+
+'''
+On-disk cache of Strava activity streams.
+
+One entry per (activity id, resolution, series_type) holding every stream key fetched so far for
+that activity. A request for a subset of the cached keys is served from the entry without calling
+Strava; fetching new keys merges them into the entry.
+'''
+
+
+class StreamCache(object):
+    def __init__(self, path='../stream_cache'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, run_id, resolution=None, series_type=None):
+        return os.path.join(self.path, f'{run_id}_{resolution or "all"}_{series_type or "none"}.pkl')
+
+    def load_entry(self, run_id, resolution=None, series_type=None):
+        entry_path = self.entry_path(run_id, resolution, series_type)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path, 'rb') as f:
+            return pickle.load(f)
+
+    def get(self, run_id, keys, resolution=None, series_type=None):
+        '''
+        :param keys:
+            (list): requested stream keys
+        :return:
+            (dict): stream key to data for the requested keys Strava returned, or None if the
+            cached entry does not cover every requested key
+        '''
+        entry = self.load_entry(run_id, resolution, series_type)
+        if entry is None or not set(keys) <= set(entry['keys']):
+            return None
+        return {k: entry['streams'][k] for k in keys if k in entry['streams']}
+
+    def put(self, run_id, keys, streams, resolution=None, series_type=None):
+        '''
+        Adds fetched streams to the entry for the activity. keys are the requested keys (Strava omits
+        keys the activity does not have, so they are remembered as covered)
+        '''
+        entry = self.load_entry(run_id, resolution, series_type) or {'keys': [], 'streams': {}}
+        entry['keys'] = sorted(set(entry['keys']) | set(keys))
+        entry['streams'].update(streams)
+        entry_path = self.entry_path(run_id, resolution, series_type)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, entry_path)
+
+    def invalidate(self, run_id):
+        '''
+        Drops every cached entry for an activity (e.g., the activity was edited on Strava)
+        '''
+        for file_name in os.listdir(self.path):
+            if file_name.startswith(f'{run_id}_'):
+                os.remove(os.path.join(self.path, file_name))
@@ -0,0 +1,108 @@
+import re
+import numpy as np
+
+'''
+Incremental decoder for the Strava streams payload (key_by_type=true), e.g.:
+    {"time": {"data": [0, 1, ...], "series_type": "distance", ...},
+     "latlng": {"data": [[37.1, -122.1], ...], ...}, ...}
+
+Bytes are fed as they arrive and each "data" array is parsed straight into a NumPy array once it
+closes, so no Python object is created per sample. latlng is returned as an N x 2 float64 array.
+'''
+
+# "<name>": followed by an object or array
+FIELD_RE = re.compile(rb'"(\w+)"\s*:\s*([\{\[])')
+NESTED_END_RE = re.compile(rb'\]\s*\]')
+INT_STREAMS = ('time',)
+
+
+class StreamsDecoder(object):
+    '''
+    Functions include:
+        * feed(chunk): consume the next bytes of the response
+        * close(): return dict of stream key -> NumPy array
+    '''
+    def __init__(self, keys=None):
+        # keys to keep; None keeps every stream in the payload
+        self.keys = None if keys is None else set(keys)
+        self.buffer = b''
+        self.current_key = None
+        self.in_data = False
+        self.streams = {}
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        while self.advance():
+            pass
+
+    def advance(self):
+        '''
+        Consumes as much of the buffer as possible. Returns False when more bytes are needed
+        '''
+        if not self.in_data:
+            match = FIELD_RE.search(self.buffer)
+            if match is None:
+                # keep a tail in case a field name is split across chunks
+                self.buffer = self.buffer[-64:]
+                return False
+            name, opener = match.group(1).decode(), match.group(2)
+            self.buffer = self.buffer[match.end():]
+            if opener == b'{':
+                self.current_key = name
+            elif name == 'data':
+                self.in_data = True
+            return True
+        stripped = self.buffer.lstrip()
+        if not stripped:
+            return False
+        if stripped[:1] == b'[':
+            # array of arrays (latlng); ends at the first "]]"
+            end_match = NESTED_END_RE.search(self.buffer)
+            if end_match is None:
+                return False
+            end, width = end_match.start(), 2
+        else:
+            end = self.buffer.find(b']')
+            if end == -1:
+                return False
+            width = 1
+        section = self.buffer[:end]
+        self.buffer = self.buffer[end + 1:]
+        self.in_data = False
+        if self.keys is None or self.current_key in self.keys:
+            self.streams[self.current_key] = decode_array(section, width, self.current_key)
+        return True
+
+    def close(self):
+        return self.streams
+
+
+def decode_array(section, width, key=None):
+    '''
+    Parses the body of a JSON number array (brackets excluded)
+    :param width:
+        (int): 1 for flat arrays, 2 for arrays of pairs (latlng)
+    :return:
+        (array): int64 for time, float64 otherwise; N x width if width > 1
+    '''
+    text = section.replace(b'[', b' ').replace(b']', b' ').replace(b'null', b'nan')
+    text = text.replace(b'true', b'1').replace(b'false', b'0')
+    values = np.fromstring(text.decode(), sep=',')
+    if width > 1:
+        values = values.reshape(-1, width)
+    if key in INT_STREAMS:
+        values = values.astype(np.int64)
+    return values
+
+
+def decode_streams(chunks, keys=None):
+    '''
+    :param chunks:
+        (iterable): bytes chunks of the response body (e.g., response.iter_content())
+    :return:
+        (dict): stream key -> NumPy array
+    '''
+    decoder = StreamsDecoder(keys)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return decoder.close()